@@ -1,152 +1,2948 @@
+import _thread
+import base64
+import csv
+import functools
+import gzip
+import hashlib
+import io
+import itertools
+import json
+import multiprocessing
 import os
+import re
+import shutil
+import sqlite3
+import subprocess
 import sys
+import tempfile
+import threading
+import time
 import zipfile
-from flask import Flask, render_template, request, redirect, url_for, send_file, send_from_directory
+import zlib
+import click
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from flask import Flask, Response, abort, g, has_request_context, jsonify, render_template, request, redirect, url_for, send_file, send_from_directory
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import func
-from werkzeug.utils import secure_filename
-from datetime import datetime
-from io import BytesIO
-from reportlab.pdfgen import canvas
-from reportlab.lib.pagesizes import A4
-from reportlab.lib.units import mm
-from reportlab.graphics.barcode import code128
-from reportlab.graphics import renderPDF
-from PIL import Image
+from sqlalchemy import and_, event, false, func, insert, inspect, literal_column, select, table, text, tuple_
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import OperationalError
+from werkzeug.wsgi import ClosingIterator
+from datetime import datetime, timezone
+from jinja2 import BytecodeCache, FileSystemBytecodeCache
+# reportlab and Pillow are imported where they are used (labels / images):
+# they are the heaviest modules and most page loads never need them
+
+try:
+    import brotli  # optional: smaller pages than gzip
+except ImportError:
+    brotli = None
 
 app = Flask(__name__)
 
-# CONFIGURATION
-# --- CONFIGURATION (UPDATED FOR EXE SUPPORT) ---
-# --- CONFIGURATION (UPDATED FOR DATA DIRECTORY) ---
-if getattr(sys, 'frozen', False):
-    # If EXE: Base dir is where the EXE lives
-    BASE_DIR = os.path.dirname(sys.executable)
-else:
-    # If Script: Base dir is where the script lives
-    BASE_DIR = os.path.abspath(os.path.dirname(__file__))
+# CONFIGURATION
+# --- CONFIGURATION (UPDATED FOR EXE SUPPORT) ---
+# --- CONFIGURATION (UPDATED FOR DATA DIRECTORY) ---
+if getattr(sys, 'frozen', False):
+    # If EXE: Base dir is where the EXE lives
+    BASE_DIR = os.path.dirname(sys.executable)
+else:
+    # If Script: Base dir is where the script lives
+    BASE_DIR = os.path.abspath(os.path.dirname(__file__))
+
+# 1. Define the DATA directory (FILMLOG_DATA_DIR points elsewhere, e.g. benchmark data)
+DATA_DIR = os.environ.get('FILMLOG_DATA_DIR') or os.path.join(BASE_DIR, 'Data')
+if not os.path.exists(DATA_DIR):
+    os.makedirs(DATA_DIR)
+
+# 2. Define IMAGES directory (Data/Images)
+IMAGES_DIR = os.path.join(DATA_DIR, 'Images')
+if not os.path.exists(IMAGES_DIR):
+    os.makedirs(IMAGES_DIR)
+
+# 2b. Define THUMBNAILS directory (Data/Thumbnails)
+# Resized copies of contact sheets. They are generated from Images, so they
+# are not included in backups (run 'flask backfill-thumbnails' to rebuild).
+THUMBS_DIR = os.path.join(DATA_DIR, 'Thumbnails')
+if not os.path.exists(THUMBS_DIR):
+    os.makedirs(THUMBS_DIR)
+
+# 2c. Define INCOMING directory (Data/Incoming)
+# Raw uploads wait here until a background worker has optimised them
+INCOMING_DIR = os.path.join(DATA_DIR, 'Incoming')
+if not os.path.exists(INCOMING_DIR):
+    os.makedirs(INCOMING_DIR)
+
+# 3. Database Config
+# Main DB (Film Log)
+app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(DATA_DIR, 'filmlog.db')
+
+# New DB (Gear Log) - Binds allows multiple DB files
+app.config['SQLALCHEMY_BINDS'] = {
+    'gear': 'sqlite:///' + os.path.join(DATA_DIR, 'gearlog.db')
+}
+app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# Enough pooled connections for the largest server thread count (see SETTING_TYPES)
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {'pool_size': 10, 'max_overflow': 30, 'pool_timeout': 30}
+
+# 4. Upload Config (Lives in Data/Images)
+app.config['UPLOAD_FOLDER'] = IMAGES_DIR
+app.config['ALLOWED_EXTENSIONS'] = {'jpg', 'jpeg', 'png'}
+
+# Widths (px) of the resized copies made for every contact sheet
+app.config['THUMBNAIL_WIDTHS'] = [320, 960, 1920]
+# None = WebP + JPEG if this Pillow build has WebP, else JPEG (see thumbnail_formats)
+app.config['THUMBNAIL_FORMATS'] = None
+
+# Worker processes for image optimisation (0 = process inside the request)
+app.config['IMAGE_WORKERS'] = max(1, min(4, (os.cpu_count() or 2) // 2))
+
+# Ensure upload directory exists
+os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+
+# 5. Search Config
+# Rolls per page of search results / the roll browser (keeps big archives snappy)
+app.config['SEARCH_PAGE_SIZE'] = 50
+app.config['ROLLS_PAGE_SIZE'] = 50
+# Set by init_database() once the FTS5 table is known to exist
+app.config['SEARCH_FTS'] = False
+
+# 6. Template Cache (Data/TemplateCache)
+# Compiled templates are kept on disk so a restart - or the EXE's cold
+# start - skips Jinja compilation. Set to None to disable.
+app.config['TEMPLATE_CACHE_DIR'] = os.path.join(DATA_DIR, 'TemplateCache')
+# Compile every template in the background right after startup
+app.config['TEMPLATE_PRECOMPILE'] = True
+
+class ConfigBytecodeCache(BytecodeCache):
+    # Reads TEMPLATE_CACHE_DIR whenever a template is loaded, so the cache
+    # can be moved or switched off after import (app.config overrides)
+    def __init__(self):
+        self._caches = {}  # directory -> FileSystemBytecodeCache
+
+    def _cache(self):
+        directory = app.config.get('TEMPLATE_CACHE_DIR')
+        if not directory:
+            return None
+        if directory not in self._caches:
+            os.makedirs(directory, exist_ok=True)
+            self._caches[directory] = FileSystemBytecodeCache(directory)
+        return self._caches[directory]
+
+    def load_bytecode(self, bucket):
+        cache = self._cache()
+        if cache:
+            cache.load_bytecode(bucket)
+
+    def dump_bytecode(self, bucket):
+        cache = self._cache()
+        if cache:
+            cache.dump_bytecode(bucket)
+
+app.jinja_env.bytecode_cache = ConfigBytecodeCache()
+
+db = SQLAlchemy(app)
+
+# DATABASE MODELS
+class Roll(db.Model):
+    id = db.Column(db.Integer, primary_key=True) 
+    film_type = db.Column(db.String(100), nullable=False)
+    iso = db.Column(db.Integer)            
+    camera = db.Column(db.String(100))
+    lens = db.Column(db.String(100))
+    date_started = db.Column(db.Date)
+    date_finished = db.Column(db.Date)
+    date_added = db.Column(db.DateTime, default=datetime.utcnow)
+    date_modified = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    contact_sheet = db.Column(db.String(200)) 
+    notes = db.Column(db.Text)
+    # Gear.id in gearlog.db (another file, so no foreign key - see GEAR LINKS)
+    camera_gear_id = db.Column(db.Integer)
+    lens_gear_id = db.Column(db.Integer)
+    
+    @property
+    def formatted_id(self):
+        """Returns ID as 0001 string"""
+        return f"{self.id:04d}"
+        
+ # Settings for GearLog       
+class Gear(db.Model):
+    __bind_key__ = 'gear'  # Tells Flask to save this in gearlog.db
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(100), nullable=False) # e.g. "Canon AE-1"
+    hardware_type = db.Column(db.String(50), nullable=False) # Camera, Lens, etc
+    serial_number = db.Column(db.String(100))
+    date_added = db.Column(db.DateTime, default=datetime.utcnow)
+    date_modified = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class VocabTerm(db.Model):
+    # Autocomplete vocabulary: every distinct film/camera/lens + how often it's used.
+    # Kept up to date by triggers on the roll table (see install_vocabulary)
+    id = db.Column(db.Integer, primary_key=True)
+    field = db.Column(db.String(20), nullable=False)  # film_type, camera, lens
+    term = db.Column(db.String(100, collation='NOCASE'), nullable=False)
+    uses = db.Column(db.Integer, nullable=False, default=0)
+    __table_args__ = (db.UniqueConstraint('field', 'term'),)
+
+class StatCount(db.Model):
+    # Precomputed roll counts for the stats page, one row per (dimension, bucket).
+    # Kept up to date by triggers on the roll table (see install_stats)
+    id = db.Column(db.Integer, primary_key=True)
+    dimension = db.Column(db.String(20), nullable=False)  # total, camera, month, finish...
+    bucket = db.Column(db.String(100), nullable=False)
+    rolls = db.Column(db.Integer, nullable=False, default=0)
+    days = db.Column(db.Float, nullable=False, default=0)  # Sum of days to finish
+    __table_args__ = (db.UniqueConstraint('dimension', 'bucket'),)
+
+class ImageJob(db.Model):
+    # Background image optimisation queue (stored so it survives restarts)
+    id = db.Column(db.Integer, primary_key=True)
+    roll_id = db.Column(db.Integer)
+    filename = db.Column(db.String(200), nullable=False)
+    state = db.Column(db.String(20), default='queued')  # queued, done, failed
+    error = db.Column(db.Text)
+    date_added = db.Column(db.DateTime, default=datetime.utcnow)
+    date_finished = db.Column(db.DateTime)
+
+class ImageAlias(db.Model):
+    # Old (timestamp_name) image filenames -> content-hashed name, so old URLs still work
+    old_name = db.Column(db.String(200), primary_key=True)
+    name = db.Column(db.String(200), nullable=False)
+
+class ImageHash(db.Model):
+    # Perceptual hash of each contact sheet, for "find similar" (see IMAGE SIMILARITY).
+    # AUTOINCREMENT ids are never reused, so a process can spot rows added by others.
+    id = db.Column(db.Integer, primary_key=True)
+    filename = db.Column(db.String(200), unique=True, nullable=False)
+    phash = db.Column(db.String(16), nullable=False)  # 64-bit dHash as hex
+    __table_args__ = {'sqlite_autoincrement': True}
+
+class AppSetting(db.Model):
+    # Stores global app preferences
+    id = db.Column(db.Integer, primary_key=True)
+    key = db.Column(db.String(50), unique=True, nullable=False)
+    value = db.Column(db.String(50)) # "true" or "false"
+# HELPER FUNCTIONS
+def allowed_file(filename):
+    return '.' in filename and filename.rsplit('.', 1)[1].lower() in app.config['ALLOWED_EXTENSIONS']
+
+# NEW: Image Optimization Function
+def save_optimized_image(file_storage, filename):
+    from PIL import Image
+
+    filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+    
+    # Open the image using Pillow
+    img = Image.open(file_storage)
+    
+    # 1. Convert to RGB (Fixes issues with some PNGs/TIFFs when saving as JPEG)
+    if img.mode in ("RGBA", "P"):
+        img = img.convert("RGB")
+        
+    # 2. Resize to fit within 4K Box (3840x2160)
+    # 'thumbnail' modifies the image in-place and PRESERVES ASPECT RATIO.
+    # It will never stretch or crop; it just shrinks it until it fits.
+    img.thumbnail((3840, 2160), Image.Resampling.LANCZOS)
+    
+    # 3. Save with optimization
+    # quality=85 reduces file size by ~60-80% with no visible quality loss
+    img.save(filepath, optimize=True, quality=85)
+
+    # 4. Smaller copies for previews (srcset)
+    generate_thumbnails(img, filename)
+
+    # 5. Perceptual hash for "find similar" (stored by the parent process)
+    return image_phash(img)
+
+# --- THUMBNAILS ---
+THUMBNAIL_FORMAT_NAMES = ('webp', 'jpeg')
+
+def thumbnail_formats():
+    """Formats to generate - probes Pillow for WebP the first time it's needed"""
+    if app.config['THUMBNAIL_FORMATS'] is None:
+        from PIL import features
+        app.config['THUMBNAIL_FORMATS'] = ['webp', 'jpeg'] if features.check('webp') else ['jpeg']
+    return app.config['THUMBNAIL_FORMATS']
+
+def thumbnail_name(filename, width, fmt):
+    # '1700000.12_scan.jpg' -> '1700000.12_scan.320.webp'
+    stem = os.path.splitext(filename)[0]
+    ext = 'jpg' if fmt == 'jpeg' else fmt
+    return f"{stem}.{width}.{ext}"
+
+def generate_thumbnails(img, filename):
+    """Writes every width/format derivative of an (already opened) image."""
+    from PIL import Image
+
+    # Largest first, each one resized from the previous (much faster than
+    # going back to the 4K original every time)
+    current = img
+    for width in sorted(app.config['THUMBNAIL_WIDTHS'], reverse=True):
+        # Never upscale - for small originals the bigger sizes are just
+        # full-resolution copies, so every srcset entry still exists
+        if width < current.width:
+            current = current.copy()
+            current.thumbnail((width, current.height), Image.Resampling.LANCZOS)
+        for fmt in thumbnail_formats():
+            path = os.path.join(THUMBS_DIR, thumbnail_name(filename, width, fmt))
+            if fmt == 'webp':
+                current.save(path, 'WEBP', quality=80, method=4)
+            else:
+                current.save(path, 'JPEG', quality=82, optimize=True, progressive=True)
+
+def remove_thumbnails(filename):
+    for width in app.config['THUMBNAIL_WIDTHS']:
+        for fmt in THUMBNAIL_FORMAT_NAMES:
+            try:
+                os.remove(os.path.join(THUMBS_DIR, thumbnail_name(filename, width, fmt)))
+            except OSError:
+                pass
+
+@app.template_global()
+def image_srcset(filename, fmt):
+    """srcset string for the derivatives that exist on disk ('' if none yet)."""
+    # (Only files on disk count, so rendering a page never loads Pillow)
+    entries = []
+    for width in sorted(app.config['THUMBNAIL_WIDTHS']):
+        if fmt not in THUMBNAIL_FORMAT_NAMES:
+            break
+        if os.path.exists(os.path.join(THUMBS_DIR, thumbnail_name(filename, width, fmt))):
+            url = url_for('serve_image_variant', filename=filename, width=width, fmt=fmt)
+            entries.append(f"{url} {width}w")
+    return ', '.join(entries)
+
+@app.cli.command('backfill-thumbnails')
+@click.option('--force', is_flag=True, help='Regenerate derivatives that already exist.')
+def backfill_thumbnails(force):
+    """Creates missing thumbnails for every image in Data/Images."""
+    from PIL import Image
+
+    made = skipped = failed = 0
+    smallest = min(app.config['THUMBNAIL_WIDTHS'])
+    for filename in sorted(os.listdir(IMAGES_DIR)):
+        if not allowed_file(filename):
+            continue
+        marker = os.path.join(THUMBS_DIR, thumbnail_name(filename, smallest, 'jpeg'))
+        if os.path.exists(marker) and not force:
+            skipped += 1
+            continue
+        try:
+            with Image.open(os.path.join(IMAGES_DIR, filename)) as img:
+                img.load()
+                if img.mode in ("RGBA", "P"):
+                    img = img.convert("RGB")
+                generate_thumbnails(img, filename)
+            made += 1
+        except (OSError, ValueError) as e:
+            failed += 1
+            click.echo(f"   ! {filename}: {e}")
+    click.echo(f" * Thumbnails: {made} generated, {skipped} already done, {failed} failed")
+
+# --- IMAGE STORE (content-addressed) ---
+# Contact sheets are named after the SHA-256 of the uploaded file, so the
+# same scan uploaded twice is stored once and shared by both rolls. A file
+# is only deleted once no roll references it (release_contact_sheet); the
+# GC pass catches anything else left behind (e.g. by a restore).
+# Files from before this scheme keep their old names until
+# 'flask dedupe-images' renames them; image_alias keeps their URLs working.
+HASHED_IMAGE_RE = re.compile(r'^[0-9a-f]{64}\.[a-z0-9]+$')
+# GC leaves files touched this recently alone (uploads whose roll is still being saved)
+app.config['IMAGE_GC_GRACE'] = 3600
+
+def stored_image_name(digest, original_filename):
+    ext = original_filename.rsplit('.', 1)[1].lower()
+    return f"{digest}.{'jpg' if ext == 'jpeg' else ext}"
+
+def image_references(filename):
+    """Rolls using this image, plus queued jobs still producing it"""
+    rolls = db.session.query(func.count(Roll.id)).filter(Roll.contact_sheet == filename).scalar()
+    jobs = ImageJob.query.filter_by(filename=filename, state='queued').count()
+    return rolls + jobs
+
+def delete_stored_image(filename):
+    """Removes an image, its resized copies and any raw upload. Returns bytes freed."""
+    freed = 0
+    paths = [os.path.join(IMAGES_DIR, filename), os.path.join(INCOMING_DIR, filename)]
+    paths += [os.path.join(THUMBS_DIR, thumbnail_name(filename, width, fmt))
+              for width in app.config['THUMBNAIL_WIDTHS'] for fmt in THUMBNAIL_FORMAT_NAMES]
+    for path in paths:
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+            freed += size
+        except OSError:
+            pass
+    forget_image_hash(filename)
+    return freed
+
+def release_contact_sheet(filename):
+    """Call after committing a change that dropped a reference to `filename`"""
+    if filename and image_references(filename) == 0:
+        delete_stored_image(filename)
+
+def resolve_image_alias(filename):
+    """Current name for a pre-dedupe filename, or None"""
+    alias = db.session.get(ImageAlias, filename)
+    return alias.name if alias else None
+
+def _hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def dedupe_legacy_images():
+    """Renames timestamp-named images to their content hash. Returns (renamed, merged, freed bytes)."""
+    renamed = merged = freed = 0
+    legacy = [name for (name,) in db.session.query(Roll.contact_sheet).filter(Roll.contact_sheet.isnot(None)).distinct()
+              if not HASHED_IMAGE_RE.match(name)]
+    for old in legacy:
+        old_path = os.path.join(IMAGES_DIR, old)
+        if not os.path.exists(old_path):
+            continue  # still being processed (or missing) - try again later
+        new = stored_image_name(_hash_file(old_path), old)
+        new_path = os.path.join(IMAGES_DIR, new)
+
+        # 1. Copy first, so some name always works if we stop half-way
+        duplicate = os.path.exists(new_path)
+        if not duplicate:
+            shutil.copy2(old_path, new_path)
+            for width in app.config['THUMBNAIL_WIDTHS']:
+                for fmt in THUMBNAIL_FORMAT_NAMES:
+                    src = os.path.join(THUMBS_DIR, thumbnail_name(old, width, fmt))
+                    if os.path.exists(src):
+                        shutil.copy2(src, os.path.join(THUMBS_DIR, thumbnail_name(new, width, fmt)))
+
+        # 2. Point the rolls at the new name and remember the old URL
+        Roll.query.filter(Roll.contact_sheet == old).update({Roll.contact_sheet: new}, synchronize_session=False)
+        ImageAlias.query.filter(ImageAlias.name == old).update({ImageAlias.name: new}, synchronize_session=False)
+        db.session.merge(ImageAlias(old_name=old, name=new))
+        db.session.commit()
+
+        # 3. Old copy is no longer needed (its perceptual hash moves along)
+        old_hash = db.session.execute(select(ImageHash.phash).where(ImageHash.filename == old)).scalar()
+        if old_hash:
+            record_image_hash(new, int(old_hash, 16))
+        freed += delete_stored_image(old)
+        if duplicate:
+            merged += 1
+        else:
+            renamed += 1
+    return renamed, merged, freed
+
+def collect_image_garbage(dry_run=False):
+    """Deletes files no roll references. Returns a report of what was (or would be) freed."""
+    grace_cutoff = time.time() - app.config['IMAGE_GC_GRACE']
+    referenced = {name for (name,) in db.session.query(Roll.contact_sheet).filter(Roll.contact_sheet.isnot(None)).distinct()}
+    referenced |= {job.filename for job in ImageJob.query.filter_by(state='queued')}
+    referenced_stems = {os.path.splitext(name)[0] for name in referenced}
+    report = {'dry_run': dry_run, 'images': 0, 'thumbnails': 0, 'incoming': 0, 'aliases': 0, 'bytes': 0}
+
+    def sweep(directory, kind, is_referenced):
+        for entry in os.scandir(directory):
+            if not entry.is_file() or is_referenced(entry.name):
+                continue
+            stat = entry.stat()
+            if stat.st_mtime > grace_cutoff:
+                continue
+            if not dry_run:
+                try:
+                    os.remove(entry.path)
+                except OSError:
+                    continue
+            report[kind] += 1
+            report['bytes'] += stat.st_size
+
+    sweep(IMAGES_DIR, 'images', lambda name: name in referenced)
+    sweep(INCOMING_DIR, 'incoming', lambda name: name in referenced)
+    # '<stem>.<width>.<ext>' belongs to the image with that stem
+    sweep(THUMBS_DIR, 'thumbnails', lambda name: name.rsplit('.', 2)[0] in referenced_stems)
+
+    # Aliases and perceptual hashes of images that are gone - the reference
+    # check runs inside SQLite (indexed NOT EXISTS), not as a parameter list
+    def unreferenced(column):
+        return and_(~select(Roll.id).where(Roll.contact_sheet == column).exists(),
+                    ~select(ImageJob.id).where(ImageJob.filename == column, ImageJob.state == 'queued').exists())
+
+    stale = ImageAlias.query.filter(unreferenced(ImageAlias.name))
+    report['aliases'] = stale.count()
+    if not dry_run:
+        stale.delete(synchronize_session=False)
+        ImageHash.query.filter(unreferenced(ImageHash.filename)).delete(synchronize_session=False)
+        db.session.commit()
+    return report
+
+@app.cli.command('dedupe-images')
+def dedupe_images_command():
+    """Renames old timestamp-named images to content hashes (merging duplicates)."""
+    renamed, merged, freed = dedupe_legacy_images()
+    click.echo(f" * {renamed} images renamed, {merged} duplicates merged, {freed / 1e6:.1f} MB freed")
+
+@app.cli.command('gc-images')
+@click.option('--dry-run', is_flag=True, help='Only report what would be deleted.')
+def gc_images_command(dry_run):
+    """Deletes images, thumbnails and uploads that no roll references."""
+    report = collect_image_garbage(dry_run=dry_run)
+    verb = 'Would free' if dry_run else 'Freed'
+    click.echo(f" * {verb} {report['bytes'] / 1e6:.1f} MB: {report['images']} images, "
+               f"{report['thumbnails']} thumbnails, {report['incoming']} uploads, {report['aliases']} aliases")
+
+# --- IMAGE SIMILARITY ---
+# Which roll does this stray print belong to? Every contact sheet gets a
+# 64-bit perceptual hash (dHash: survives resizing, recompression and small
+# tone changes). Similar images have hashes a few bits apart, so a search
+# is a nearest-neighbour lookup by Hamming distance (see HammingIndex).
+app.config['SIMILAR_MAX_DISTANCE'] = 12  # Of 64 bits - beyond this it is another image
+SIMILAR_DISTANCE_CAP = 19  # Larger radii make the block lookups too broad
+app.config['SIMILAR_LIMIT'] = 10
+HASH_BACKFILL_BATCH = 500
+
+def image_phash(img):
+    """64-bit difference hash of a PIL image: one bit per 'is the next pixel brighter'"""
+    from PIL import Image
+
+    small = img.convert('L').resize((9, 8), Image.Resampling.BOX)
+    pixels = list(small.getdata())
+    bits = 0
+    for row in range(8):
+        for col in range(8):
+            bits = (bits << 1) | (pixels[row * 9 + col] < pixels[row * 9 + col + 1])
+    return bits
+
+def file_phash(fp):
+    """Perceptual hash of an image file (path or file object)"""
+    from PIL import Image
+
+    with Image.open(fp) as img:
+        # JPEGs decode straight to a small greyscale image - much faster
+        img.draft('L', (256, 256))
+        return image_phash(img)
+
+def hamming(a, b):
+    return bin(a ^ b).count('1')
+
+HASH_BLOCKS = 4  # 64-bit hash = 4 blocks of 16 bits
+HASH_BLOCK_BITS = 64 // HASH_BLOCKS
+
+@functools.lru_cache(maxsize=None)
+def block_masks(max_bits):
+    """Every 16-bit XOR mask that flips at most max_bits bits"""
+    return [sum(1 << bit for bit in bits)
+            for k in range(max_bits + 1)
+            for bits in itertools.combinations(range(HASH_BLOCK_BITS), k)]
+
+class HammingIndex:
+    # Multi-index hashing: each hash is filed under its four 16-bit blocks.
+    # Two hashes at most r bits apart share at least one block that differs
+    # by at most r // 4 bits (pigeonhole), so a search looks up the few
+    # hundred neighbours of each query block and only compares the hashes
+    # filed there - not the whole collection.
+    def __init__(self):
+        self.hashes = {}  # filename -> hash
+        self.blocks = [{} for _ in range(HASH_BLOCKS)]  # block value -> filenames
+
+    def __len__(self):
+        return len(self.hashes)
+
+    @staticmethod
+    def _split(phash):
+        mask = (1 << HASH_BLOCK_BITS) - 1
+        return [(phash >> (HASH_BLOCK_BITS * i)) & mask for i in range(HASH_BLOCKS)]
+
+    def add(self, phash, filename):
+        self.remove(filename)
+        self.hashes[filename] = phash
+        for block, value in zip(self.blocks, self._split(phash)):
+            block.setdefault(value, set()).add(filename)
+
+    def remove(self, filename):
+        phash = self.hashes.pop(filename, None)
+        if phash is None:
+            return
+        for block, value in zip(self.blocks, self._split(phash)):
+            names = block[value]
+            names.discard(filename)
+            if not names:
+                del block[value]
+
+    def search(self, phash, max_distance, limit):
+        """Up to `limit` (distance, filename) pairs within max_distance, nearest first"""
+        candidates = set()
+        masks = block_masks(max_distance // HASH_BLOCKS)
+        for block, value in zip(self.blocks, self._split(phash)):
+            for mask in masks:
+                names = block.get(value ^ mask)
+                if names:
+                    candidates.update(names)
+        results = []
+        for name in candidates:
+            distance = hamming(self.hashes[name], phash)
+            if distance <= max_distance:
+                results.append((distance, name))
+        results.sort()
+        return results[:limit]
+
+class SimilarityIndex:
+    # Built from image_hash the first time it is searched, then kept in step:
+    # rows added since (by any process) are inserted, deletions made here are
+    # applied directly, and anything else (a restore, another server deleting)
+    # shows up as a count mismatch and rebuilds it.
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self._index = None
+        self._last_id = 0
+
+    def __len__(self):
+        return len(self._index) if self._index else 0
+
+    def _add_rows(self, rows):
+        for row_id, filename, phash in rows:
+            self._index.add(int(phash, 16), filename)
+            self._last_id = max(self._last_id, row_id)
+
+    def _sync(self):
+        last_id, count = db.session.execute(select(func.max(ImageHash.id), func.count(ImageHash.id))).one()
+        last_id = last_id or 0
+        if self._index is not None and last_id > self._last_id:
+            self._add_rows(db.session.execute(select(ImageHash.id, ImageHash.filename, ImageHash.phash)
+                                              .where(ImageHash.id > self._last_id)))
+        if self._index is None or last_id < self._last_id or count != len(self._index):
+            self.reset()
+            self._index = HammingIndex()
+            self._add_rows(db.session.execute(select(ImageHash.id, ImageHash.filename, ImageHash.phash)))
+
+    def discard(self, filename):
+        with self._lock:
+            if self._index is not None:
+                self._index.remove(filename)
+
+    def search(self, phash, max_distance, limit):
+        with self._lock:
+            self._sync()
+            return self._index.search(phash, max_distance, limit)
+
+image_index = SimilarityIndex()
+
+def record_image_hash(filename, phash):
+    """Stores a contact sheet's perceptual hash (replacing an older one)"""
+    forget_image_hash(filename)
+    db.session.add(ImageHash(filename=filename, phash=f'{phash:016x}'))
+    db.session.commit()
+
+def forget_image_hash(filename):
+    if ImageHash.query.filter_by(filename=filename).delete(synchronize_session=False):
+        db.session.commit()
+    image_index.discard(filename)
+
+def find_similar_rolls(phash, max_distance=None, limit=None):
+    """Rolls whose contact sheet looks like the image with this hash, nearest first"""
+    max_distance = app.config['SIMILAR_MAX_DISTANCE'] if max_distance is None else max_distance
+    max_distance = min(max(max_distance, 0), SIMILAR_DISTANCE_CAP)
+    limit = limit or app.config['SIMILAR_LIMIT']
+    started = time.perf_counter()
+    hits = image_index.search(phash, max_distance, limit)
+    metrics.observe('filmlog_similar_search_seconds', time.perf_counter() - started)
+
+    # One query for the rolls behind the matched files (shared files -> several rolls)
+    distances = {filename: distance for distance, filename in hits}
+    rolls = Roll.query.filter(Roll.contact_sheet.in_(distances)).all() if distances else []
+    rolls.sort(key=lambda roll: (distances[roll.contact_sheet], roll.id))
+    return [(roll, distances[roll.contact_sheet]) for roll in rolls[:limit]]
+
+@app.cli.command('backfill-image-hashes')
+@click.option('--force', is_flag=True, help='Recompute hashes that already exist.')
+def backfill_image_hashes(force):
+    """Computes perceptual hashes for every image in Data/Images."""
+    if force:
+        ImageHash.query.delete(synchronize_session=False)
+        db.session.commit()
+    known = {name for (name,) in db.session.query(ImageHash.filename)}
+    made = failed = 0
+    started = time.time()
+    for filename in sorted(os.listdir(IMAGES_DIR)):
+        if not allowed_file(filename) or filename in known:
+            continue
+        try:
+            db.session.add(ImageHash(filename=filename, phash=f'{file_phash(os.path.join(IMAGES_DIR, filename)):016x}'))
+            made += 1
+        except (OSError, ValueError) as e:
+            failed += 1
+            click.echo(f"   ! {filename}: {e}")
+            continue
+        if made % HASH_BACKFILL_BATCH == 0:
+            db.session.commit()
+    db.session.commit()
+    click.echo(f" * Image hashes: {made} computed, {len(known) if not force else 0} already done, "
+               f"{failed} failed ({time.time() - started:.1f}s)")
+
+# --- AUTOCOMPLETE VOCABULARY ---
+VOCAB_FIELDS = ['film_type', 'camera', 'lens']
+
+def _vocab_add_sql(field, row):
+    return (f"INSERT INTO vocab_term(field, term, uses) "
+            f"SELECT '{field}', {row}.{field}, 1 WHERE coalesce({row}.{field}, '') != '' "
+            f"ON CONFLICT(field, term) DO UPDATE SET uses = uses + 1;")
+
+def _vocab_remove_sql(field, row):
+    return (f"UPDATE vocab_term SET uses = uses - 1 "
+            f"WHERE field = '{field}' AND term = {row}.{field};")
+
+VOCAB_DDL = [
+    "CREATE TRIGGER IF NOT EXISTS vocab_ai AFTER INSERT ON roll BEGIN "
+    + ' '.join(_vocab_add_sql(f, 'new') for f in VOCAB_FIELDS) + " END",
+    "CREATE TRIGGER IF NOT EXISTS vocab_ad AFTER DELETE ON roll BEGIN "
+    + ' '.join(_vocab_remove_sql(f, 'old') for f in VOCAB_FIELDS)
+    + " DELETE FROM vocab_term WHERE uses <= 0; END",
+    "CREATE TRIGGER IF NOT EXISTS vocab_au AFTER UPDATE OF film_type, camera, lens ON roll BEGIN "
+    + ' '.join(_vocab_remove_sql(f, 'old') + ' ' + _vocab_add_sql(f, 'new') for f in VOCAB_FIELDS)
+    + " DELETE FROM vocab_term WHERE uses <= 0; END",
+]
+
+def install_vocabulary(conn, rebuild=False):
+    """Creates the vocabulary triggers and (re)counts terms if the table is new or empty."""
+    for statement in VOCAB_DDL:
+        conn.execute(text(statement))
+    empty = conn.execute(text("SELECT 1 FROM vocab_term LIMIT 1")).first() is None
+    if rebuild or empty:
+        conn.execute(text("DELETE FROM vocab_term"))
+        for field in VOCAB_FIELDS:
+            conn.execute(text(
+                f"INSERT INTO vocab_term(field, term, uses) "
+                f"SELECT '{field}', {field}, COUNT(*) FROM roll "
+                f"WHERE coalesce({field}, '') != '' GROUP BY {field} COLLATE NOCASE"
+            ))
+
+def suggest_terms(field, prefix, limit=10):
+    """Most used terms of a field starting with prefix (case-insensitive)."""
+    # A range on the NOCASE (field, term) index instead of LIKE, so SQLite
+    # jumps straight to the prefix rather than scanning the vocabulary
+    return VocabTerm.query.filter(
+        VocabTerm.field == field,
+        VocabTerm.term >= prefix,
+        VocabTerm.term < prefix + '\uffff',
+    ).order_by(VocabTerm.uses.desc(), VocabTerm.term).limit(limit).all()
+
+# --- STATISTICS AGGREGATES ---
+# Days from date_started to date_finished (NULL if unknown or backwards)
+_FINISH_DAYS = ("(CASE WHEN {r}.date_finished >= {r}.date_started "
+                "THEN julianday({r}.date_finished) - julianday({r}.date_started) END)")
+
+FINISH_BUCKETS = ['Under a week', '1-4 weeks', '1-3 months', '3-12 months', 'Over a year']
+
+# dimension -> SQL for the bucket of row {r} (NULL = not counted)
+STAT_DIMENSIONS = {
+    'total': "'all'",
+    'film_type': "nullif({r}.film_type, '')",
+    'camera': "nullif({r}.camera, '')",
+    'lens': "nullif({r}.lens, '')",
+    'iso': "CAST({r}.iso AS TEXT)",
+    'month': "strftime('%Y-%m', coalesce({r}.date_started, {r}.date_added))",
+    'finish': ("(CASE WHEN {d} IS NULL THEN NULL "
+               "WHEN {d} < 7 THEN 'Under a week' "
+               "WHEN {d} < 30 THEN '1-4 weeks' "
+               "WHEN {d} < 91 THEN '1-3 months' "
+               "WHEN {d} < 365 THEN '3-12 months' "
+               "ELSE 'Over a year' END)"),
+}
+
+def _stat_bucket(dimension, row):
+    return STAT_DIMENSIONS[dimension].format(r=row, d=_FINISH_DAYS.format(r=row))
+
+def _stat_days(row):
+    return f"coalesce({_FINISH_DAYS.format(r=row)}, 0)"
+
+def _stat_add_sql(dimension, row):
+    bucket = _stat_bucket(dimension, row)
+    return (f"INSERT INTO stat_count(dimension, bucket, rolls, days) "
+            f"SELECT '{dimension}', {bucket}, 1, {_stat_days(row)} WHERE {bucket} IS NOT NULL "
+            f"ON CONFLICT(dimension, bucket) DO UPDATE SET rolls = rolls + 1, days = days + excluded.days;")
+
+def _stat_remove_sql(dimension, row):
+    return (f"UPDATE stat_count SET rolls = rolls - 1, days = days - {_stat_days(row)} "
+            f"WHERE dimension = '{dimension}' AND bucket = {_stat_bucket(dimension, row)};")
+
+STATS_DDL = [
+    "CREATE TRIGGER IF NOT EXISTS stats_ai AFTER INSERT ON roll BEGIN "
+    + ' '.join(_stat_add_sql(d, 'new') for d in STAT_DIMENSIONS) + " END",
+    "CREATE TRIGGER IF NOT EXISTS stats_ad AFTER DELETE ON roll BEGIN "
+    + ' '.join(_stat_remove_sql(d, 'old') for d in STAT_DIMENSIONS)
+    + " DELETE FROM stat_count WHERE rolls <= 0; END",
+    "CREATE TRIGGER IF NOT EXISTS stats_au AFTER UPDATE ON roll BEGIN "
+    + ' '.join(_stat_remove_sql(d, 'old') + ' ' + _stat_add_sql(d, 'new') for d in STAT_DIMENSIONS)
+    + " DELETE FROM stat_count WHERE rolls <= 0; END",
+]
+
+def install_stats(conn, rebuild=False):
+    """Creates the stats triggers and recounts everything if the table is new or empty."""
+    for statement in STATS_DDL:
+        conn.execute(text(statement))
+    empty = conn.execute(text("SELECT 1 FROM stat_count LIMIT 1")).first() is None
+    if rebuild or empty:
+        conn.execute(text("DELETE FROM stat_count"))
+        for dimension in STAT_DIMENSIONS:
+            bucket = _stat_bucket(dimension, 'roll')
+            conn.execute(text(
+                f"INSERT INTO stat_count(dimension, bucket, rolls, days) "
+                f"SELECT '{dimension}', {bucket} AS b, COUNT(*), SUM({_stat_days('roll')}) "
+                f"FROM roll WHERE b IS NOT NULL GROUP BY b"
+            ))
+
+def stat_rows(dimension, limit=None, order='count'):
+    """[(bucket, rolls)] for one dimension, biggest first (or by bucket name)."""
+    query = db.session.query(StatCount.bucket, StatCount.rolls).filter_by(dimension=dimension)
+    if order == 'count':
+        query = query.order_by(StatCount.rolls.desc(), StatCount.bucket)
+    else:
+        query = query.order_by(StatCount.bucket.desc())
+    if limit:
+        query = query.limit(limit)
+    return query.all()
+
+@app.cli.command('rebuild-stats')
+def rebuild_stats():
+    """Recounts every statistics aggregate from the roll table."""
+    with db.engine.begin() as conn:
+        install_stats(conn, rebuild=True)
+    total = StatCount.query.filter_by(dimension='total').first()
+    click.echo(f" * Stats rebuilt for {total.rolls if total else 0} rolls")
+
+# --- BACKGROUND IMAGE JOBS ---
+# Resizing + encoding a big scan takes seconds, so uploads are written to
+# Data/Incoming as-is and a process pool does the optimisation. The ImageJob
+# row is committed together with the roll, so a restart simply resumes it.
+image_pool = None
+image_pool_lock = threading.Lock()
+image_futures = {}  # job id -> Future (jobs submitted by this process)
+
+def get_image_pool():
+    global image_pool
+    with image_pool_lock:
+        if image_pool is None:
+            image_pool = ProcessPoolExecutor(max_workers=app.config['IMAGE_WORKERS'])
+        return image_pool
+
+def reset_image_pool(broken):
+    """Drops a pool whose worker died (OOM, crash in Pillow), so the next
+    submit starts a fresh one instead of failing for good."""
+    global image_pool
+    with image_pool_lock:
+        if image_pool is broken:
+            image_pool = None
+    broken.shutdown(wait=False, cancel_futures=True)
+
+def stage_upload(file_storage, roll_id):
+    """Saves the raw upload under its content hash and adds its ImageJob to the
+    session (commit with the roll). Returns (filename, job); job is None when
+    the same image is already stored or queued."""
+    digest = hashlib.sha256()
+    fd, tmp_path = tempfile.mkstemp(suffix='.upload', dir=INCOMING_DIR)
+    with os.fdopen(fd, 'wb') as f:
+        for chunk in iter(lambda: file_storage.stream.read(1 << 20), b''):
+            digest.update(chunk)
+            f.write(chunk)
+    filename = stored_image_name(digest.hexdigest(), file_storage.filename)
+
+    stored = os.path.join(IMAGES_DIR, filename)
+    if os.path.exists(stored):
+        os.utime(stored)  # In use again - keeps the GC grace period away from it
+        os.remove(tmp_path)
+        return filename, None
+    if ImageJob.query.filter_by(filename=filename, state='queued').first():
+        os.remove(tmp_path)
+        return filename, None
+
+    os.replace(tmp_path, os.path.join(INCOMING_DIR, filename))
+    job = ImageJob(roll_id=roll_id, filename=filename)
+    db.session.add(job)
+    return filename, job
+
+def run_image_job(filename):
+    # Runs in a worker process: optimise the raw upload into Data/Images.
+    # Returns how long it took (recorded in /metrics by the parent) and the
+    # image's perceptual hash
+    started = time.perf_counter()
+    phash = save_optimized_image(os.path.join(INCOMING_DIR, filename), filename)
+    return time.perf_counter() - started, phash
+
+def submit_image_job(job_id, filename):
+    if app.config['IMAGE_WORKERS'] == 0:
+        future = Future()
+        try:
+            future.set_result(run_image_job(filename))
+        except Exception as e:
+            future.set_exception(e)
+    else:
+        pool = get_image_pool()
+        try:
+            future = pool.submit(run_image_job, filename)
+        except BrokenProcessPool:
+            # Retry once on a fresh pool
+            reset_image_pool(pool)
+            try:
+                future = get_image_pool().submit(run_image_job, filename)
+            except BrokenProcessPool as e:
+                future = Future()
+                future.set_exception(e)
+    image_futures[job_id] = future
+    future.add_done_callback(lambda f: _finish_image_job(job_id, filename, f))
+
+def _finish_image_job(job_id, filename, future):
+    # Called in the parent process once the worker is done
+    if future.cancelled():
+        # Cancelled at shutdown: the job stays queued for the next start
+        image_futures.pop(job_id, None)
+        return
+    error = future.exception()
+    metrics.inc('filmlog_image_jobs_total', result='failed' if error else 'done')
+    if not error:
+        elapsed, phash = future.result()
+        metrics.observe('filmlog_image_processing_seconds', elapsed)
+    with app.app_context():
+        job = db.session.get(ImageJob, job_id)
+        if job:
+            job.state = 'failed' if error else 'done'
+            job.error = str(error) if error else None
+            job.date_finished = datetime.utcnow()
+            db.session.commit()
+        if not error:
+            record_image_hash(filename, phash)
+        db.session.remove()
+    if not error:
+        try:
+            os.remove(os.path.join(INCOMING_DIR, filename))
+        except OSError:
+            pass
+    image_futures.pop(job_id, None)
+
+def resume_image_jobs():
+    """Re-submits jobs left queued by a previous run. Call inside an app context."""
+    resumed = 0
+    for job in ImageJob.query.filter_by(state='queued').order_by(ImageJob.id):
+        if os.path.exists(os.path.join(INCOMING_DIR, job.filename)):
+            submit_image_job(job.id, job.filename)
+            resumed += 1
+        else:
+            job.state = 'failed'
+            job.error = 'Upload missing from Data/Incoming'
+    db.session.commit()
+    return resumed
+
+def image_job_status(job):
+    future = image_futures.get(job.id)
+    state = job.state
+    if state == 'queued' and future is not None and future.running():
+        state = 'running'
+    return {
+        'id': job.id,
+        'roll_id': job.roll_id,
+        'filename': job.filename,
+        'state': state,
+        'error': job.error,
+        'date_added': job.date_added.isoformat() if job.date_added else None,
+        'date_finished': job.date_finished.isoformat() if job.date_finished else None,
+    }
+
+# --- SEARCH INDEX (SQLite FTS5) ---
+# The index is an "external content" FTS5 table: it stores only the search
+# tokens and points back at roll.id. Triggers on the roll table keep it in
+# sync, so add/edit/delete (and anything else writing to roll) update it
+# automatically inside the same transaction.
+SEARCH_INDEX_DDL = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS roll_fts USING fts5(
+        film_type, camera, lens, notes,
+        content='roll', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2',
+        prefix='2 3'
+    )""",
+    """CREATE TRIGGER IF NOT EXISTS roll_fts_ai AFTER INSERT ON roll BEGIN
+        INSERT INTO roll_fts(rowid, film_type, camera, lens, notes)
+        VALUES (new.id, new.film_type, new.camera, new.lens, new.notes);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS roll_fts_ad AFTER DELETE ON roll BEGIN
+        INSERT INTO roll_fts(roll_fts, rowid, film_type, camera, lens, notes)
+        VALUES ('delete', old.id, old.film_type, old.camera, old.lens, old.notes);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS roll_fts_au AFTER UPDATE ON roll BEGIN
+        INSERT INTO roll_fts(roll_fts, rowid, film_type, camera, lens, notes)
+        VALUES ('delete', old.id, old.film_type, old.camera, old.lens, old.notes);
+        INSERT INTO roll_fts(rowid, film_type, camera, lens, notes)
+        VALUES (new.id, new.film_type, new.camera, new.lens, new.notes);
+    END""",
+]
+
+def search_index_exists(conn):
+    return conn.execute(text(
+        "SELECT 1 FROM sqlite_master WHERE type='table' AND name='roll_fts'"
+    )).first() is not None
+
+def install_search_index(conn, rebuild=False):
+    """Creates the FTS5 table + triggers if missing (OperationalError without FTS5)."""
+    exists = search_index_exists(conn)
+    for statement in SEARCH_INDEX_DDL:
+        conn.execute(text(statement))
+    # A fresh table (or a DB restored from an older backup) needs filling
+    if rebuild or not exists:
+        conn.execute(text("INSERT INTO roll_fts(roll_fts) VALUES ('rebuild')"))
+
+def build_fts_query(search_query):
+    # Turn free text into a safe FTS5 query: every word becomes a quoted
+    # prefix term, e.g. 'kodak gol' -> '"kodak"* "gol"*' (all must match)
+    words = re.findall(r'\w+', search_query)
+    return ' '.join(f'"{w}"*' for w in words)
+
+def search_roll_query(search_query):
+    """(query, relevance key) for a text search over film_type, camera, lens and notes."""
+    if app.config.get('SEARCH_FTS'):
+        match = build_fts_query(search_query)
+        if not match:
+            return Roll.query.filter(false()), Roll.id
+        # bm25: lower = better match
+        matches = select(
+            literal_column('rowid').label('roll_id'),
+            literal_column('bm25(roll_fts)', db.Float).label('score'),
+        ).select_from(table('roll_fts')).where(
+            text('roll_fts MATCH :match').bindparams(match=match)
+        ).subquery()
+        return Roll.query.join(matches, matches.c.roll_id == Roll.id), matches.c.score
+
+    # Fallback: partial match (full scan), newest first
+    return Roll.query.filter(
+        (Roll.film_type.contains(search_query)) |
+        (Roll.camera.contains(search_query)) |
+        (Roll.lens.contains(search_query)) |
+        (Roll.notes.contains(search_query))
+    ), -Roll.id
+
+# --- ROLL PAGER (keyset pagination) ---
+# Pages are addressed by the sort key + id of the last (or first) row shown,
+# never by OFFSET, so page 2000 costs the same as page 1. Each sort key has
+# a matching index (see MIGRATIONS).
+ROLL_SORTS = {
+    'id': Roll.id,
+    'date': func.coalesce(Roll.date_started, literal_column("''"), type_=db.String),
+    'camera': func.coalesce(Roll.camera, literal_column("''"), type_=db.String).collate('NOCASE'),
+}
+
+def encode_cursor(key, roll_id):
+    raw = json.dumps([key, roll_id]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+def decode_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        key, roll_id = json.loads(raw)
+        return key, int(roll_id)
+    except (ValueError, TypeError):
+        return None  # Bad cursor - just show the first page
+
+def paginate_rolls(query, sort_key, descending=True, after=None, before=None, per_page=None):
+    """One page of `query` ordered by (sort_key, id). Returns a dict with rolls + cursors."""
+    per_page = per_page or app.config['ROLLS_PAGE_SIZE']
+    after = decode_cursor(after) if after else None
+    before = decode_cursor(before) if before else None
+    by_id = sort_key is Roll.id
+
+    # Going backwards = walk the index the other way, then flip the page
+    backwards = before is not None and after is None
+    walk_desc = descending != backwards
+    cursor = before if backwards else after
+
+    if cursor is not None:
+        key, roll_id = cursor
+        if by_id:
+            condition = Roll.id < roll_id if walk_desc else Roll.id > roll_id
+        # The extra bound on the key alone lets SQLite seek into the index
+        # (a row-value comparison on its own makes it scan from the start)
+        elif walk_desc:
+            condition = and_(sort_key <= key, tuple_(sort_key, Roll.id) < tuple_(key, roll_id))
+        else:
+            condition = and_(sort_key >= key, tuple_(sort_key, Roll.id) > tuple_(key, roll_id))
+        query = query.filter(condition)
+
+    if by_id:
+        order = [Roll.id.desc() if walk_desc else Roll.id.asc()]
+    else:
+        order = [sort_key.desc(), Roll.id.desc()] if walk_desc else [sort_key.asc(), Roll.id.asc()]
+
+    rows = query.add_columns(sort_key.label('sort_key')).order_by(*order).limit(per_page + 1).all()
+    more = len(rows) > per_page
+    rows = rows[:per_page]
+    if backwards:
+        rows.reverse()
+
+    if backwards:
+        has_prev, has_next = more, True
+    else:
+        has_prev, has_next = cursor is not None, more
+
+    return {
+        'rolls': [row[0] for row in rows],
+        'prev_cursor': encode_cursor(rows[0][1], rows[0][0].id) if rows and has_prev else None,
+        'next_cursor': encode_cursor(rows[-1][1], rows[-1][0].id) if rows and has_next else None,
+    }
+
+# --- ROLL VALIDATION (shared by the forms and the bulk importer) ---
+def parse_date(date_str):
+    """YYYY-MM-DD -> date, None if blank or invalid"""
+    if date_str:
+        try:
+            return datetime.strptime(str(date_str).strip(), '%Y-%m-%d').date()
+        except ValueError:
+            return None
+    return None
+
+def parse_iso(iso_input):
+    """Box speed -> int, None if blank. Raises ValueError if not a number."""
+    if iso_input is None or str(iso_input).strip() == '':
+        return None
+    return int(str(iso_input).strip())
+
+def roll_id_taken(roll_id):
+    return db.session.get(Roll, roll_id) is not None
+
+# --- BULK ROLL IMPORT (CSV / JSON) ---
+# Files are read as a stream and written in batches, one transaction per
+# batch, so a 20k-row spreadsheet never sits in memory. Rows that fail
+# validation are skipped and reported; the rest are imported.
+app.config['IMPORT_BATCH_SIZE'] = 1000
+# Only the first N row errors are kept in the report (all are counted)
+app.config['IMPORT_MAX_ERRORS'] = 500
+
+ROLL_IMPORT_FORMATS = {'csv': 'csv', 'json': 'json', 'jsonl': 'jsonl', 'ndjson': 'jsonl'}
+ROLL_TEXT_FIELDS = {'film_type': 100, 'camera': 100, 'lens': 100}
+
+def import_format(filename):
+    ext = filename.rsplit('.', 1)[-1].lower() if '.' in filename else ''
+    return ROLL_IMPORT_FORMATS.get(ext)
+
+def iter_json_array(text_stream, chunk_size=65536):
+    """Yields the objects of a top-level JSON array without reading it all"""
+    decoder = json.JSONDecoder()
+    buf, pos = '', 0
+    started = eof = False
+    while True:
+        # 1. Skip whitespace and separators between items
+        while pos < len(buf) and buf[pos] in ' \t\r\n,':
+            pos += 1
+        if pos >= len(buf):
+            if eof:
+                raise ValueError('Unexpected end of JSON file')
+            buf, pos = text_stream.read(chunk_size), 0
+            eof = not buf
+            continue
+
+        if not started:
+            if buf[pos] != '[':
+                raise ValueError('JSON file must contain an array of rolls')
+            started = True
+            pos += 1
+            continue
+        if buf[pos] == ']':
+            return
+
+        # 2. Decode the next item, topping the buffer up if it is cut off
+        try:
+            item, pos = decoder.raw_decode(buf, pos)
+        except json.JSONDecodeError as e:
+            more = '' if eof else text_stream.read(chunk_size)
+            if not more:
+                raise ValueError(f'Invalid JSON: {e.msg}')
+            buf, pos = buf[pos:] + more, 0
+            continue
+        yield item
+
+def iter_import_records(text_stream, fmt):
+    """Yields one dict per roll (or the ValueError for an unreadable line)"""
+    if fmt == 'csv':
+        yield from csv.DictReader(text_stream)
+    elif fmt == 'jsonl':
+        for line in text_stream:
+            if line.strip():
+                try:
+                    yield json.loads(line)
+                except ValueError as e:
+                    yield ValueError(f'Invalid JSON: {e}')
+    else:
+        yield from iter_json_array(text_stream)
+
+def validate_roll_record(record):
+    """Same rules as the Add Roll form. Returns (values, errors)."""
+    if isinstance(record, Exception):
+        return None, [str(record)]
+    if not isinstance(record, dict):
+        return None, ['Expected an object with roll fields']
+
+    def field(name):
+        value = record.get(name)
+        return '' if value is None else str(value).strip()
+
+    errors = []
+    values = {'id': None, 'notes': field('notes') or None}
+
+    raw_id = field('id') or field('roll_id')
+    if raw_id:
+        try:
+            values['id'] = int(raw_id)
+            if values['id'] < 1:
+                errors.append(f"Invalid Roll ID '{raw_id}'")
+        except ValueError:
+            errors.append(f"Invalid Roll ID '{raw_id}'")
+
+    for name, max_len in ROLL_TEXT_FIELDS.items():
+        values[name] = field(name) or None
+        if values[name] and len(values[name]) > max_len:
+            errors.append(f'{name} is longer than {max_len} characters')
+    if not values['film_type']:
+        errors.append('film_type is required')
+
+    try:
+        values['iso'] = parse_iso(record.get('iso'))
+    except ValueError:
+        errors.append(f"Invalid ISO '{field('iso')}'")
+
+    for name in ('date_started', 'date_finished'):
+        values[name] = parse_date(field(name))
+        if field(name) and values[name] is None:
+            errors.append(f"Invalid {name} '{field(name)}' (expected YYYY-MM-DD)")
+
+    return values, errors
+
+def import_rolls(text_stream, fmt, dry_run=False, batch_size=None):
+    """Validates and inserts rolls from a CSV/JSON stream. Returns the report."""
+    batch_size = batch_size or app.config['IMPORT_BATCH_SIZE']
+    max_errors = app.config['IMPORT_MAX_ERRORS']
+    started = time.time()
+    report = {'dry_run': dry_run, 'rows': 0, 'imported': 0, 'failed': 0, 'errors': [], 'aborted': None}
+
+    def reject(row_num, errors):
+        report['failed'] += 1
+        if len(report['errors']) < max_errors:
+            report['errors'].append({'row': row_num, 'errors': errors})
+
+    # Rows without an ID are numbered on from the current highest roll
+    next_id = (db.session.query(func.max(Roll.id)).scalar() or 0) + 1
+    seen_ids = set()
+    batch = []
+
+    def flush():
+        # 1. Duplicate-ID check against the database: one IN query per batch
+        ids = [values['id'] for _, values in batch]
+        taken = set(db.session.scalars(select(Roll.id).where(Roll.id.in_(ids))))
+        rows = []
+        for row_num, values in batch:
+            if values['id'] in taken:
+                reject(row_num, [f"Roll #{values['id']:04d} already exists in the database"])
+            else:
+                rows.append(values)
+
+        # 2. One transaction for the whole batch (triggers keep search/stats in sync)
+        if rows and not dry_run:
+            try:
+                db.session.execute(insert(Roll), rows)
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                raise
+        report['imported'] += len(rows)
+        batch.clear()
+
+    try:
+        for row_num, record in enumerate(iter_import_records(text_stream, fmt), start=1):
+            report['rows'] = row_num
+            values, errors = validate_roll_record(record)
+            if not errors:
+                if values['id'] is None:
+                    while next_id in seen_ids:
+                        next_id += 1
+                    values['id'] = next_id
+                    next_id += 1
+                elif values['id'] in seen_ids:
+                    errors.append(f"Roll #{values['id']:04d} is already used by an earlier row")
+            if errors:
+                reject(row_num, errors)
+                continue
+
+            seen_ids.add(values['id'])
+            batch.append((row_num, values))
+            if len(batch) >= batch_size:
+                flush()
+    except (ValueError, UnicodeDecodeError, csv.Error) as e:
+        # Unreadable file: rows read so far are still imported (the pending
+        # batch included, so every counted row is imported or rejected);
+        # the rest of the file is skipped
+        report['aborted'] = f'Stopped after row {report["rows"]}: {e}'
+
+    if batch:
+        flush()
+    if report['imported'] and not dry_run:
+        # One set-based pass links the new rolls to gear by name
+        relink_rolls()
+    report['elapsed'] = round(time.time() - started, 2)
+    return report
+
+@app.cli.command('import-rolls')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--dry-run', is_flag=True, help='Validate only, write nothing.')
+@click.option('--batch-size', type=int, default=None, help='Rows per transaction.')
+def import_rolls_command(path, dry_run, batch_size):
+    """Bulk import rolls from a CSV, JSON or JSON Lines file"""
+    fmt = import_format(path)
+    if not fmt:
+        raise click.UsageError('File must be .csv, .json, .jsonl or .ndjson')
+    with open(path, encoding='utf-8-sig', newline='') as f:
+        report = import_rolls(f, fmt, dry_run=dry_run, batch_size=batch_size)
+
+    for err in report['errors']:
+        click.echo(f" * Row {err['row']}: {'; '.join(err['errors'])}", err=True)
+    if report['aborted']:
+        click.echo(f" * {report['aborted']}", err=True)
+    verb = 'would be imported' if dry_run else 'imported'
+    click.echo(f" * {report['rows']} rows read, {report['imported']} {verb}, {report['failed']} rejected "
+               f"({report['elapsed']}s).")
+
+# --- CHANGE TRACKING (ETags for the JSON API) ---
+# Each DB file keeps a change counter per table, bumped by triggers, so an
+# API client's cached copy can be validated with one tiny lookup instead of
+# reading the rows. Rows carry their own date_modified for per-item ETags.
+CHANGE_TRACKED_TABLES = {None: 'roll', 'gear': 'gear'}
+
+def _change_bump_sql(tbl):
+    return ("INSERT INTO change_counter(name, version, modified) "
+            f"VALUES ('{tbl}', 1, datetime('now')) "
+            "ON CONFLICT(name) DO UPDATE SET version = version + 1, modified = excluded.modified;")
+
+def install_change_tracking(conn, bind_key):
+    tbl = CHANGE_TRACKED_TABLES[bind_key]
+    # 1. date_modified column (db.create_all() already adds it to new DB files)
+    columns = [row[1] for row in conn.exec_driver_sql(f"PRAGMA table_info({tbl})")]
+    if 'date_modified' not in columns:
+        conn.exec_driver_sql(f"ALTER TABLE {tbl} ADD COLUMN date_modified DATETIME")
+
+    # 2. Counter table + triggers
+    install_change_counter(conn, tbl)
+
+def install_change_counter(conn, tbl):
+    conn.exec_driver_sql("CREATE TABLE IF NOT EXISTS change_counter ("
+                         "name TEXT PRIMARY KEY, version INTEGER NOT NULL, modified TEXT NOT NULL)")
+    for event_name, suffix in (('INSERT', 'ai'), ('DELETE', 'ad'), ('UPDATE', 'au')):
+        conn.exec_driver_sql(f"CREATE TRIGGER IF NOT EXISTS {tbl}_changes_{suffix} "
+                             f"AFTER {event_name} ON {tbl} BEGIN {_change_bump_sql(tbl)} END")
+    conn.exec_driver_sql(_change_bump_sql(tbl))
+
+def change_version(model):
+    """(version, last modified) of a tracked table - never reads its rows"""
+    row = db.session.execute(text("SELECT version, modified FROM change_counter WHERE name = :name"),
+                             {'name': model.__table__.name},
+                             bind_arguments={'mapper': model.__mapper__}).first()
+    if row is None:
+        return 0, None
+    return row.version, datetime.strptime(row.modified, '%Y-%m-%d %H:%M:%S')
+
+# --- GEAR LINKS ---
+# Rolls point at the Gear items they were shot with. Gear lives in
+# gearlog.db, so every filmlog.db connection ATTACHes it as "gearlog" (see
+# set_sqlite_pragmas): usage reports are then one query over both files.
+# The free-text camera/lens name is the matching hint: a link is set when
+# the name matches exactly one item of that type, and it only changes when
+# the text does, so renaming a gear item keeps its rolls.
+GEAR_SCHEMA = 'gearlog'
+FILMLOG_DB_PATH = os.path.abspath(os.path.join(DATA_DIR, 'filmlog.db'))
+GEARLOG_DB_PATH = os.path.abspath(os.path.join(DATA_DIR, 'gearlog.db'))
+# roll text column -> (link column, Gear.hardware_type)
+GEAR_LINK_FIELDS = {'camera': ('camera_gear_id', 'Camera'), 'lens': ('lens_gear_id', 'Lens')}
+
+def _gear_match_sql(field):
+    # The one gear item named like roll.<field>, NULL if none or ambiguous
+    column, hw_type = GEAR_LINK_FIELDS[field]
+    return (f"(SELECT min(g.id) FROM {GEAR_SCHEMA}.gear g WHERE g.hardware_type = '{hw_type}' "
+            f"AND trim(g.name) = trim(roll.{field}) COLLATE NOCASE HAVING count(*) = 1)")
+
+def link_rolls_to_gear(conn):
+    """Links every unlinked roll whose camera/lens names exactly one gear item."""
+    linked = 0
+    for field, (column, _) in GEAR_LINK_FIELDS.items():
+        match = _gear_match_sql(field)
+        result = conn.execute(text(
+            f"UPDATE roll SET {column} = {match}, date_modified = datetime('now') "
+            f"WHERE {column} IS NULL AND nullif(trim({field}), '') IS NOT NULL AND {match} IS NOT NULL"))
+        linked += result.rowcount
+    return linked
+
+def unlink_gear(gear_id):
+    """Clears the links to a deleted gear item (its ID may be reused later)."""
+    for column, _ in GEAR_LINK_FIELDS.values():
+        db.session.execute(text(f"UPDATE roll SET {column} = NULL, date_modified = datetime('now') "
+                                f"WHERE {column} = :id"), {'id': gear_id})
+    # A name that was ambiguous may now match the remaining item
+    link_rolls_to_gear(db.session)
+    db.session.commit()
+
+def relink_rolls():
+    """Call after gear was added or renamed: picks up rolls that now match."""
+    if link_rolls_to_gear(db.session):
+        db.session.commit()
+
+def match_gear_id(hw_type, name):
+    """Gear.id of the one item of this type called `name`, else None"""
+    if not name or not name.strip():
+        return None
+    ids = db.session.execute(select(Gear.id).where(
+        Gear.hardware_type == hw_type,
+        func.trim(Gear.name).collate('NOCASE') == name.strip()).limit(2)).scalars().all()
+    return ids[0] if len(ids) == 1 else None
+
+def link_roll_gear(roll):
+    """Points a new or edited roll at the gear its camera/lens text names."""
+    state = inspect(roll)
+    for field, (column, hw_type) in GEAR_LINK_FIELDS.items():
+        if state.transient or state.pending or state.attrs[field].history.has_changes():
+            setattr(roll, column, match_gear_id(hw_type, getattr(roll, field)))
+
+def install_gear_links(conn):
+    # 1. Link columns (db.create_all() already adds them to new DB files)
+    columns = [row[1] for row in conn.exec_driver_sql("PRAGMA table_info(roll)")]
+    for column, _ in GEAR_LINK_FIELDS.values():
+        if column not in columns:
+            conn.exec_driver_sql(f"ALTER TABLE roll ADD COLUMN {column} INTEGER")
+        # Covering the dates lets the usage report run from the index alone
+        conn.exec_driver_sql(f"CREATE INDEX IF NOT EXISTS ix_roll_{column} "
+                             f"ON roll({column}, date_finished, date_started)")
+    # 2. Existing rolls: use the names typed so far as the matching hint
+    linked = link_rolls_to_gear(conn)
+    print(f" * Linked {linked} roll camera/lens entries to gear items")
+
+# Roll count + last used date per gear item. Both link columns have covering
+# indexes, so this reads only index entries of linked rolls.
+GEAR_USAGE_SQL = f"""
+    WITH used AS (
+        SELECT camera_gear_id AS gear_id, coalesce(date_finished, date_started) AS day
+        FROM roll WHERE camera_gear_id IS NOT NULL
+        UNION ALL
+        SELECT lens_gear_id, coalesce(date_finished, date_started)
+        FROM roll WHERE lens_gear_id IS NOT NULL
+    ), usage AS (
+        SELECT gear_id, count(*) AS rolls, max(day) AS last_used FROM used GROUP BY gear_id
+    )
+    SELECT g.id, g.name, g.hardware_type, g.serial_number,
+           coalesce(u.rolls, 0) AS rolls, u.last_used
+    FROM {GEAR_SCHEMA}.gear g LEFT JOIN usage u ON u.gear_id = g.id
+    WHERE :hardware_type IS NULL OR g.hardware_type = :hardware_type
+    ORDER BY g.hardware_type, g.name
+"""
+
+def gear_usage(hardware_type=None):
+    """Every gear item with its roll count and last-used date, in one query"""
+    return db.session.execute(text(GEAR_USAGE_SQL), {'hardware_type': hardware_type}).all()
+
+# --- JSON API HELPERS ---
+app.config['API_PAGE_SIZE'] = 100
+app.config['API_MAX_PAGE_SIZE'] = 500
+# Most IDs accepted by one batch lookup (stays far below SQLite's variable limit)
+app.config['API_BATCH_LIMIT'] = 500
+
+def api_error(status, message, **extra):
+    response = jsonify(error=message, **extra)
+    response.status_code = status
+    return response
+
+def api_etag(*parts):
+    return hashlib.sha1(repr(parts).encode()).hexdigest()[:20]
+
+def api_not_modified(etag, last_modified):
+    """True if the client's cached copy (If-None-Match / If-Modified-Since) is current"""
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    if request.if_modified_since and last_modified:
+        return last_modified.replace(tzinfo=timezone.utc, microsecond=0) <= request.if_modified_since
+    return False
+
+def api_response(payload, etag, last_modified, status=200):
+    if status == 200 and api_not_modified(etag, last_modified):
+        response = Response(status=304)
+    else:
+        response = jsonify(payload)
+        response.status_code = status
+    response.set_etag(etag)
+    if last_modified:
+        response.last_modified = last_modified
+    # Clients may cache, but must revalidate (cheap thanks to the ETag)
+    response.cache_control.no_cache = True
+    return response
+
+def api_cached(etag, last_modified):
+    """304 response to send before any rows are loaded, or None"""
+    if api_not_modified(etag, last_modified):
+        return api_response(None, etag, last_modified)
+    return None
+
+def api_json_body():
+    payload = request.get_json(silent=True)
+    if not isinstance(payload, dict):
+        abort(api_error(400, 'Request body must be a JSON object'))
+    return payload
+
+def api_batch_ids():
+    """IDs for a batch lookup: ?ids=1,2,3 or a JSON body {"ids": [...]}"""
+    if request.method == 'POST':
+        raw = api_json_body().get('ids')
+    else:
+        raw = [part for part in request.args.get('ids', '').split(',') if part.strip()]
+    if not isinstance(raw, list) or not raw:
+        abort(api_error(400, 'ids must be a non-empty list of IDs'))
+    if len(raw) > app.config['API_BATCH_LIMIT']:
+        abort(api_error(400, f"At most {app.config['API_BATCH_LIMIT']} IDs per request"))
+    try:
+        return list(dict.fromkeys(int(str(i).strip()) for i in raw))
+    except ValueError:
+        abort(api_error(400, 'ids must be integers'))
+
+def api_per_page():
+    try:
+        per_page = int(request.args.get('per_page', app.config['API_PAGE_SIZE']))
+    except ValueError:
+        per_page = app.config['API_PAGE_SIZE']
+    return min(max(per_page, 1), app.config['API_MAX_PAGE_SIZE'])
+
+def item_modified(item):
+    return item.date_modified or item.date_added
+
+def roll_etag(roll_id, modified):
+    return api_etag('roll', roll_id, modified)
+
+def gear_etag(gear_id, modified):
+    return api_etag('gear', gear_id, modified)
+
+def roll_to_dict(roll):
+    return {
+        'id': roll.id,
+        'formatted_id': roll.formatted_id,
+        'film_type': roll.film_type,
+        'iso': roll.iso,
+        'camera': roll.camera,
+        'lens': roll.lens,
+        'date_started': roll.date_started.isoformat() if roll.date_started else None,
+        'date_finished': roll.date_finished.isoformat() if roll.date_finished else None,
+        'notes': roll.notes,
+        'contact_sheet': url_for('serve_image', filename=roll.contact_sheet) if roll.contact_sheet else None,
+        'camera_gear_id': roll.camera_gear_id,
+        'lens_gear_id': roll.lens_gear_id,
+        'date_added': roll.date_added.isoformat() if roll.date_added else None,
+        'date_modified': item_modified(roll).isoformat() if item_modified(roll) else None,
+    }
+
+def gear_to_dict(gear):
+    return {
+        'id': gear.id,
+        'name': gear.name,
+        'hardware_type': gear.hardware_type,
+        'serial_number': gear.serial_number,
+        'date_added': gear.date_added.isoformat() if gear.date_added else None,
+        'date_modified': item_modified(gear).isoformat() if item_modified(gear) else None,
+    }
+
+ROLL_API_FIELDS = ['film_type', 'iso', 'camera', 'lens', 'date_started', 'date_finished', 'notes']
+GEAR_API_FIELDS = {'name': 100, 'hardware_type': 50, 'serial_number': 100}
+
+def validate_gear_record(record):
+    """Returns (values, errors) for a gear item, like validate_roll_record"""
+    errors = []
+    values = {}
+    for name, max_len in GEAR_API_FIELDS.items():
+        value = record.get(name)
+        values[name] = str(value).strip() if value is not None and str(value).strip() else None
+        if values[name] and len(values[name]) > max_len:
+            errors.append(f'{name} is longer than {max_len} characters')
+    for name in ('name', 'hardware_type'):
+        if not values[name]:
+            errors.append(f'{name} is required')
+    return values, errors
+
+# --- SCAN SESSIONS ---
+# Auditing a box of canisters: the scan page collects IDs in the browser and
+# resolves them in batches through /api/v1/scan (one IN query per batch,
+# only the columns the table shows) instead of a page load per scan.
+app.config['SCAN_SESSION_LIMIT'] = 5000  # Most codes per lookup/export
+
+# What a scanner types: "0042", "42" or the label text "ROLL #0042"
+SCAN_CODE_RE = re.compile(r'(?:ROLL\s*)?#?\s*(\d{1,9})', re.IGNORECASE)
+SCAN_EXPORT_FIELDS = ['roll_id', 'status', 'times_scanned', 'film_type', 'iso',
+                      'camera', 'lens', 'date_started', 'date_finished']
+
+def parse_scan_code(code):
+    """Scanned text -> roll ID, None if it is not a roll ID"""
+    match = SCAN_CODE_RE.fullmatch(str(code).strip())
+    return int(match.group(1)) if match else None
+
+def resolve_scans(codes):
+    """Resolves a scan session. Returns (entries, invalid codes).
+
+    One entry per distinct roll ID in first-scan order, with its status
+    (found/missing), how often it was scanned and the roll's columns.
+    """
+    counts = {}
+    invalid = []
+    for code in codes:
+        roll_id = parse_scan_code(code)
+        if roll_id is None:
+            invalid.append(str(code))
+        else:
+            counts[roll_id] = counts.get(roll_id, 0) + 1
+
+    ids = list(counts)
+    found = {}
+    limit = app.config['API_BATCH_LIMIT']
+    for start in range(0, len(ids), limit):
+        rows = db.session.execute(
+            select(Roll.id, Roll.film_type, Roll.iso, Roll.camera, Roll.lens,
+                   Roll.date_started, Roll.date_finished)
+            .where(Roll.id.in_(ids[start:start + limit])))
+        found.update((row.id, row) for row in rows)
+
+    entries = []
+    for roll_id in ids:
+        row = found.get(roll_id)
+        entries.append({
+            'id': roll_id,
+            'formatted_id': f'{roll_id:04d}',
+            'status': 'found' if row else 'missing',
+            'scans': counts[roll_id],
+            'duplicate': counts[roll_id] > 1,
+            'film_type': row.film_type if row else None,
+            'iso': row.iso if row else None,
+            'camera': row.camera if row else None,
+            'lens': row.lens if row else None,
+            'date_started': row.date_started.isoformat() if row and row.date_started else None,
+            'date_finished': row.date_finished.isoformat() if row and row.date_finished else None,
+            'url': url_for('roll_detail', roll_id=roll_id) if row else None,
+        })
+    return entries, invalid
+
+def scan_summary(entries, invalid):
+    return {
+        'scanned': sum(e['scans'] for e in entries) + len(invalid),
+        'rolls': len(entries),
+        'found': sum(1 for e in entries if e['status'] == 'found'),
+        'missing': sum(1 for e in entries if e['status'] == 'missing'),
+        'duplicates': sum(1 for e in entries if e['duplicate']),
+        'invalid': len(invalid),
+    }
+
+# --- SCHEMA MIGRATIONS ---
+# Each database file stores its schema version in PRAGMA user_version.
+# db.create_all() only adds missing tables; everything else (indexes,
+# triggers, derived tables) is a numbered step below. Steps run in order,
+# one transaction each, the first time an older DB file is opened - which
+# also upgrades Data folders restored from old backups. Never edit a
+# released step: add a new one.
+
+def _migrate_search_index(conn):
+    try:
+        install_search_index(conn)
+    except OperationalError:
+        # SQLite was built without FTS5 - search falls back to LIKE
+        print(" * SQLite has no FTS5 support - using basic search")
+
+MIGRATIONS = {
+    None: [  # filmlog.db
+        (1, "Indexes on searched and sorted roll columns", [
+            "CREATE INDEX IF NOT EXISTS ix_roll_film_type ON roll(film_type)",
+            "CREATE INDEX IF NOT EXISTS ix_roll_camera ON roll(camera)",
+            "CREATE INDEX IF NOT EXISTS ix_roll_lens ON roll(lens)",
+            "CREATE INDEX IF NOT EXISTS ix_roll_date_started ON roll(date_started)",
+            "CREATE INDEX IF NOT EXISTS ix_roll_date_added ON roll(date_added)",
+            "CREATE INDEX IF NOT EXISTS ix_image_job_state ON image_job(state)",
+        ]),
+        (2, "Full-text search index", _migrate_search_index),
+        (3, "Autocomplete vocabulary", install_vocabulary),
+        (4, "Statistics aggregates", install_stats),
+        (5, "Indexes for the roll browser sorts", [
+            "CREATE INDEX IF NOT EXISTS ix_roll_sort_date ON roll(coalesce(date_started, ''), id)",
+            "CREATE INDEX IF NOT EXISTS ix_roll_sort_camera ON roll(coalesce(camera, '') COLLATE NOCASE, id)",
+        ]),
+        (6, "Change tracking for the JSON API", lambda conn: install_change_tracking(conn, None)),
+        (7, "Image reference lookups", [
+            "CREATE INDEX IF NOT EXISTS ix_roll_contact_sheet ON roll(contact_sheet)",
+            "CREATE INDEX IF NOT EXISTS ix_image_job_filename ON image_job(filename)",
+        ]),
+        (8, "Links from rolls to gear items", install_gear_links),
+        # Lets the settings cache ignore commits that did not touch a setting
+        (9, "Change tracking for app settings", lambda conn: install_change_counter(conn, 'app_setting')),
+    ],
+    'gear': [  # gearlog.db
+        (1, "Indexes on gear sort columns", [
+            "CREATE INDEX IF NOT EXISTS ix_gear_type_name ON gear(hardware_type, name)",
+        ]),
+        (2, "Change tracking for the JSON API", lambda conn: install_change_tracking(conn, 'gear')),
+    ],
+}
+
+def schema_version(bind_key):
+    with db.engines[bind_key].connect() as conn:
+        return conn.exec_driver_sql('PRAGMA user_version').scalar()
+
+def migrate_database(bind_key):
+    """Applies pending steps to one bind. Returns the list of steps applied."""
+    applied = []
+    for step, description, action in MIGRATIONS[bind_key]:
+        with db.engines[bind_key].begin() as conn:
+            if conn.exec_driver_sql('PRAGMA user_version').scalar() >= step:
+                continue
+            if callable(action):
+                action(conn)
+            else:
+                for statement in action:
+                    conn.execute(text(statement))
+            conn.exec_driver_sql(f'PRAGMA user_version = {int(step)}')
+        applied.append(step)
+        print(f" * Migrated {bind_key or 'filmlog'} DB to v{step}: {description}")
+    return applied
+
+def init_database():
+    """Creates missing tables and brings both DB files up to the latest schema."""
+    db.create_all()
+    for bind_key in MIGRATIONS:
+        migrate_database(bind_key)
+    with db.engine.connect() as conn:
+        app.config['SEARCH_FTS'] = search_index_exists(conn)
+
+@app.cli.command('migrate')
+def migrate_command():
+    """Upgrades filmlog.db and gearlog.db to the latest schema."""
+    init_database()
+    for bind_key in MIGRATIONS:
+        click.echo(f" * {bind_key or 'filmlog'} DB is at v{schema_version(bind_key)}")
+
+# --- SQLITE TUNING ---
+# Applied to every new connection of both engines
+app.config['SQLITE_PRAGMAS'] = {
+    'journal_mode': 'WAL',       # Readers don't block the writer (and vice versa)
+    'synchronous': 'NORMAL',     # Safe with WAL, far fewer fsyncs
+    'mmap_size': 256 * 1024 * 1024,
+    'cache_size': -32000,        # Negative = KiB, so ~32 MB page cache
+    'busy_timeout': 5000,        # Wait (ms) instead of failing on a locked DB
+}
+
+@event.listens_for(Engine, 'connect')
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    for name, value in app.config['SQLITE_PRAGMAS'].items():
+        cursor.execute(f'PRAGMA {name}={value}')
+    # filmlog.db connections can also read gearlog.db (see GEAR LINKS)
+    main_file = cursor.execute('PRAGMA database_list').fetchone()[2]
+    if main_file and os.path.normcase(os.path.abspath(main_file)) == os.path.normcase(FILMLOG_DB_PATH):
+        cursor.execute(f'ATTACH DATABASE ? AS {GEAR_SCHEMA}', (GEARLOG_DB_PATH,))
+    cursor.close()
+
+# --- SETTINGS CACHE ---
+# AppSetting rows almost never change, but they are read on every render.
+# Keep them in memory and check for changes once per request: 'PRAGMA
+# data_version' on a private connection changes whenever ANY other
+# connection (another thread, another process, another server) commits, so
+# the check is cheap and still correct when several servers share one Data
+# folder. Only then is the app_setting change counter read, and the rows
+# are reloaded only if it moved - a roll edit doesn't reload the settings.
+
+# key -> (type, default)
+SETTING_TYPES = {
+    'enable_gearlog': (bool, False),
+    'server_port': (int, 5000),
+    'server_host': (str, '0.0.0.0'),
+    'server_mode': (str, 'production'),  # 'production' (waitress) or 'development'
+    'server_threads': (int, 8),
+    'server_connections': (int, 100),
+}
+# Allowed ranges for the numeric server settings
+SERVER_THREADS_RANGE = (1, 32)
+SERVER_CONNECTIONS_RANGE = (10, 1000)
+
+def _convert_setting(raw, kind, default):
+    if raw is None:
+        return default
+    if kind is bool:
+        return raw == 'true'
+    try:
+        return kind(raw)
+    except (TypeError, ValueError):
+        return default
+
+class SettingsCache:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._raw = None           # {key: raw string value}
+        self._watch = None         # private sqlite3 connection for data_version
+        self._data_version = None
+        self._settings_version = None
+
+    def _current_data_version(self):
+        if self._watch is None:
+            self._watch = sqlite3.connect(db.engine.url.database, check_same_thread=False)
+        return self._watch.execute('PRAGMA data_version').fetchone()[0]
+
+    def _current_settings_version(self):
+        try:
+            row = self._watch.execute("SELECT version FROM change_counter WHERE name = 'app_setting'").fetchone()
+        except sqlite3.Error:
+            return None  # Not migrated yet - any commit counts as a change
+        return row[0] if row else None
+
+    def _load(self):
+        rows = db.session.execute(text('SELECT "key", value FROM app_setting')).all()
+        return {k: v for k, v in rows}
+
+    def invalidate(self):
+        """Drops the cached values (call after writing AppSetting or swapping the DB)."""
+        with self._lock:
+            self._raw = None
+            self._data_version = None
+            self._settings_version = None
+            # The DB file may have been replaced (import_backup) - reopen next time
+            if self._watch is not None:
+                self._watch.close()
+                self._watch = None
+        if has_request_context():
+            g.pop('settings_raw', None)
+
+    def raw(self):
+        # One check per request; later reads in the same request reuse it
+        if has_request_context() and 'settings_raw' in g:
+            return g.settings_raw
+        with self._lock:
+            try:
+                version = self._current_data_version()
+            except sqlite3.Error:
+                version = None
+            if self._raw is None or version is None or version != self._data_version:
+                settings_version = self._current_settings_version() if version is not None else None
+                if self._raw is None or settings_version is None or settings_version != self._settings_version:
+                    try:
+                        self._raw = self._load()
+                    except OperationalError:
+                        # Table not created yet - use defaults for now
+                        self._raw = {}
+                        version = settings_version = None
+                self._data_version = version
+                self._settings_version = settings_version
+            raw = self._raw
+        if has_request_context():
+            g.settings_raw = raw
+        return raw
+
+    def get(self, key):
+        kind, default = SETTING_TYPES.get(key, (str, None))
+        return _convert_setting(self.raw().get(key), kind, default)
+
+    def all(self):
+        return {key: self.get(key) for key in SETTING_TYPES}
+
+settings = SettingsCache()
+
+# --- BACKUP HELPERS ---
+BACKUP_CHUNK_SIZE = 1024 * 1024  # 1 MB per read/yield
+BACKUP_DATABASES = ['filmlog.db', 'gearlog.db']
+
+class ZipStreamBuffer:
+    # Write-only "file" for zipfile. It holds only the bytes written since the
+    # last pop(), so the generator can hand them to the client straight away.
+    # It has no seek()/tell(), which makes zipfile use streaming mode.
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+def snapshot_database(db_path, snapshot_path):
+    """Copies a live SQLite DB using the online backup API (never a torn copy)."""
+    src = sqlite3.connect(db_path)
+    dst = sqlite3.connect(snapshot_path)
+    try:
+        # Copies in steps; SQLite restarts the copy itself if a write sneaks in
+        src.backup(dst, pages=1024)
+    finally:
+        dst.close()
+        src.close()
+
+# Manifests of the image backups made here, so the next one can be incremental
+BACKUP_MANIFEST_DIR = os.path.join(DATA_DIR, 'Backups')
+BACKUP_MANIFEST = 'manifest.json'
+BACKUP_KINDS = ('full', 'incremental', 'differential')
+
+def new_backup_id():
+    # Sorts by time, so the newest manifest is simply the last file name
+    return datetime.now().strftime('%Y%m%d-%H%M%S-%f-') + os.urandom(2).hex()
+
+def load_backup_manifest(backup_id):
+    """Returns the recorded manifest of an earlier backup, or None."""
+    if not backup_id or not re.fullmatch(r'[0-9a-f-]+', backup_id):
+        return None
+    try:
+        with open(os.path.join(BACKUP_MANIFEST_DIR, backup_id + '.json')) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def latest_backup_manifest(kind=None):
+    """Newest recorded image backup (only full ones when kind='full')."""
+    if not os.path.isdir(BACKUP_MANIFEST_DIR):
+        return None
+    for name in sorted(os.listdir(BACKUP_MANIFEST_DIR), reverse=True):
+        if not name.endswith('.json'):
+            continue
+        manifest = load_backup_manifest(name[:-5])
+        if manifest and (kind is None or manifest.get('kind') == kind):
+            return manifest
+    return None
+
+def save_backup_manifest(manifest):
+    os.makedirs(BACKUP_MANIFEST_DIR, exist_ok=True)
+    path = os.path.join(BACKUP_MANIFEST_DIR, manifest['id'] + '.json')
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f)
+    os.replace(path + '.tmp', path)
+
+def backup_base(mode, since=None):
+    """Picks the manifest an incremental/differential backup is relative to.
+
+    incremental  - the last image backup of any kind (smallest archives)
+    differential - the last full backup (only that one is needed to restore)
+    since=<id>   - an explicit earlier backup
+    Returns None (= make a full backup) when there is nothing to build on.
+    """
+    if since:
+        return load_backup_manifest(since)
+    if mode == 'incremental':
+        return latest_backup_manifest()
+    if mode == 'differential':
+        return latest_backup_manifest(kind='full')
+    return None
+
+def stream_backup_zip(include_images, base=None, kind=None):
+    """Generator yielding the backup zip piece by piece.
+
+    Every archive ends with a manifest.json listing the sha256 and size of the
+    databases and of ALL current images. With a base manifest only the images
+    that are new or changed since that backup go into the zip. Images are
+    stored as-is (JPEG/PNG/WebP do not deflate), databases are deflated.
+    """
+    sink = ZipStreamBuffer()
+    kind = kind or ('full' if base is None else 'incremental')
+    manifest = {
+        'format': 1,
+        'id': new_backup_id(),
+        'created': datetime.now(timezone.utc).isoformat(),
+        'kind': kind if include_images else 'data',
+        'base': base['id'] if base else None,
+        # The full backup at the start of the chain
+        'root': (base.get('root') or base['id']) if base else None,
+        'databases': {},
+        'images': {},
+        'included': 0,
+    }
+
+    def add_file(zip_file, file_path, arcname, compress_type):
+        info = zipfile.ZipInfo.from_file(file_path, arcname)
+        info.compress_type = compress_type
+        digest = hashlib.sha256()
+        with open(file_path, 'rb') as src, zip_file.open(info, 'w') as dst:
+            while True:
+                chunk = src.read(BACKUP_CHUNK_SIZE)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                dst.write(chunk)
+                yield sink.pop()
+        return {'sha256': digest.hexdigest(), 'size': info.file_size}
+
+    with zipfile.ZipFile(sink, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+        # 1. Databases (Film + Gear) - consistent snapshots, always included
+        for name in BACKUP_DATABASES:
+            db_path = os.path.join(DATA_DIR, name)
+            if not os.path.exists(db_path):
+                continue
+            fd, snapshot_path = tempfile.mkstemp(suffix='.snapshot', dir=DATA_DIR)
+            os.close(fd)
+            try:
+                snapshot_database(db_path, snapshot_path)
+                entry = yield from add_file(zip_file, snapshot_path, name, zipfile.ZIP_DEFLATED)
+                manifest['databases'][name] = entry
+            finally:
+                os.remove(snapshot_path)
+
+        # 2. Images (Optional) - preserving the "Images/" folder structure
+        if include_images and os.path.exists(IMAGES_DIR):
+            base_images = base['images'] if base else {}
+            for file in sorted(os.listdir(IMAGES_DIR)):
+                file_path = os.path.join(IMAGES_DIR, file)
+                if not os.path.isfile(file_path):
+                    continue
+                stat = os.stat(file_path)
+                mtime = int(stat.st_mtime)
+                known = base_images.get(file)
+                # Unchanged since the base: no read, no hash. Content-hashed
+                # names never change content, so their size is enough.
+                if known and known['size'] == stat.st_size and (
+                        HASHED_IMAGE_RE.match(file) or known.get('mtime') == mtime):
+                    manifest['images'][file] = dict(known, mtime=mtime)
+                    continue
+                entry = yield from add_file(zip_file, file_path, 'Images/' + file, zipfile.ZIP_STORED)
+                manifest['images'][file] = dict(entry, mtime=mtime)
+                manifest['included'] += 1
+
+        zip_file.writestr(BACKUP_MANIFEST, json.dumps(manifest, indent=1))
+
+    # Central directory is written on close
+    yield sink.pop()
+
+    # Only a backup that was streamed to the end can be built upon
+    if include_images:
+        save_backup_manifest(manifest)
+        print(f" * Backup {manifest['id']} ({manifest['kind']}): "
+              f"{manifest['included']} of {len(manifest['images'])} images included")
+
+# --- RESTORE HELPERS ---
+# Progress of the current (or last) restore, read by /import_backup/status
+import_progress = {'state': 'idle'}
+import_progress_lock = threading.Lock()
+# Only one restore may run at a time
+restore_lock = threading.Lock()
+
+def get_import_progress():
+    with import_progress_lock:
+        return dict(import_progress)
+
+def _set_import_progress(**changes):
+    with import_progress_lock:
+        import_progress.update(changes)
+        if import_progress.get('started'):
+            elapsed = max(time.time() - import_progress['started'], 0.001)
+            import_progress['elapsed'] = round(elapsed, 2)
+            import_progress['mb_per_s'] = round(import_progress.get('bytes_done', 0) / elapsed / 1e6, 2)
+
+def _restore_target(member):
+    """Maps a zip member name to where it belongs on disk (or None to skip it)."""
+    # Block malicious paths (basic security)
+    if '..' in member or member.startswith('/') or member.startswith('\\'):
+        return None
+
+    # CASE A: Database Files (Extract to DATA_DIR)
+    if member in BACKUP_DATABASES:
+        return os.path.join(DATA_DIR, member)
+
+    # CASE B: Images - the zip stores them as "Images/filename.jpg"
+    if member.startswith('Images/'):
+        filename = os.path.basename(member)
+        if filename:  # Ensure it's not just the folder itself
+            return os.path.join(IMAGES_DIR, filename)
+    return None
+
+def _replace_retrying(src, dst):
+    # Windows can keep a file locked for a moment after closing, so retry briefly
+    for attempt in range(10):
+        try:
+            os.replace(src, dst)
+            return
+        except PermissionError:
+            if attempt == 9:
+                raise
+            time.sleep(0.2)
+
+def swap_databases(staged):
+    """Moves staged DB files over the live ones as one unit and reconnects.
+
+    Every live file is renamed aside before any staged file goes in, so a
+    failure part-way through puts all of the old files back."""
+    # 1. Close every pooled connection (both binds) before touching the files.
+    # Each filmlog connection also ATTACHes gearlog.db, so no bind may keep one.
+    db.session.remove()
+    for engine in db.engines.values():
+        engine.dispose()
+    settings.invalidate()
+
+    # 2. Flush any WAL content of the old DBs, then drop the side files so
+    # they can never be replayed on top of the new DBs
+    for _, live_path in staged:
+        if os.path.exists(live_path):
+            conn = sqlite3.connect(live_path)
+            try:
+                conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+            finally:
+                conn.close()
+        for suffix in ('-wal', '-shm', '-journal'):
+            if os.path.exists(live_path + suffix):
+                os.remove(live_path + suffix)
+
+    # 3. Rename all live files aside, then move all staged files in
+    # (same folder, so each os.replace is atomic)
+    set_aside = []   # (aside_path, live_path)
+    swapped_in = []  # live paths that now hold a staged file
+    try:
+        for _, live_path in staged:
+            if os.path.exists(live_path):
+                _replace_retrying(live_path, live_path + '.previous')
+                set_aside.append((live_path + '.previous', live_path))
+        for staged_path, live_path in staged:
+            _replace_retrying(staged_path, live_path)
+            swapped_in.append(live_path)
+    except Exception:
+        # Roll back: drop whatever went in and restore the old files
+        for live_path in swapped_in:
+            if os.path.exists(live_path):
+                os.remove(live_path)
+        for aside_path, live_path in set_aside:
+            _replace_retrying(aside_path, live_path)
+        raise
+
+    for aside_path, _ in set_aside:
+        os.remove(aside_path)
+    # The engines open fresh connections to the new files on next use
+
+def read_backup_manifest(z):
+    """Manifest of an open backup zip. Archives from before manifests were
+    added count as full backups of whatever they contain."""
+    try:
+        return json.loads(z.read(BACKUP_MANIFEST))
+    except KeyError:
+        images = {}
+        for info in z.infolist():
+            target = _restore_target(info.filename)
+            if target and info.filename not in BACKUP_DATABASES:
+                images[os.path.basename(target)] = {'size': info.file_size}
+        return {'id': None, 'created': '', 'kind': 'full', 'base': None, 'images': images}
+
+def plan_backup_chain(archives):
+    """Decides which member of which archive restores each file.
+
+    archives is a list of (ZipFile, manifest). The newest archive describes
+    the state to restore: its databases, and every image its manifest lists,
+    taken from the newest archive that carries it. Images already on disk
+    with the same content are left alone. Returns [(ZipFile, ZipInfo, target)].
+    """
+    def already_restored(filename, entry, target):
+        if not os.path.exists(target) or os.path.getsize(target) != entry['size']:
+            return False
+        # A content-hashed name can't hold other content; an old name can,
+        # so check its hash (archives from before manifests only know the size)
+        if HASHED_IMAGE_RE.match(filename) or 'sha256' not in entry:
+            return True
+        return _hash_file(target) == entry['sha256']
+
+    archives = sorted(archives, key=lambda a: a[1].get('created') or '')
+    newest_zip, newest = archives[-1]
+    plan = []
+
+    for name in BACKUP_DATABASES:
+        for z, _ in reversed(archives):
+            try:
+                plan.append((z, z.getinfo(name), os.path.join(DATA_DIR, name)))
+                break
+            except KeyError:
+                continue
+
+    missing = []
+    for filename, entry in newest['images'].items():
+        target = os.path.join(IMAGES_DIR, filename)
+        source = None
+        for z, _ in reversed(archives):
+            try:
+                source = z.getinfo('Images/' + filename)
+                break
+            except KeyError:
+                continue
+        if source is not None:
+            if already_restored(filename, entry, target):
+                continue
+            plan.append((z, source, target))
+        elif not already_restored(filename, entry, target):
+            missing.append(filename)
+
+    if missing:
+        needed = newest.get('base') or newest.get('root')
+        hint = f" - add backup {needed} (and the backups it builds on)" if needed else ""
+        raise ValueError(f"{len(missing)} image(s) are not in the uploaded backups{hint}")
+    return plan
+
+def restore_backup_zip(zip_sources):
+    """Restores a backup zip - or a full backup plus its incrementals - without
+    loading members into memory. Returns progress stats."""
+    if not isinstance(zip_sources, (list, tuple)):
+        zip_sources = [zip_sources]
+    if not restore_lock.acquire(blocking=False):
+        raise RuntimeError("Another restore is already running")
+    try:
+        zips = [zipfile.ZipFile(source) for source in zip_sources]
+        try:
+            return _restore_backup_chain([(z, read_backup_manifest(z)) for z in zips])
+        finally:
+            for z in zips:
+                z.close()
+    finally:
+        restore_lock.release()
+
+def _restore_backup_chain(archives):
+    plan = plan_backup_chain(archives)
+
+    _set_import_progress(state='extracting', started=time.time(), bytes_done=0,
+                         bytes_total=sum(info.file_size for _, info, _ in plan),
+                         files_done=0, files_total=len(plan), archives=len(archives),
+                         error=None)
+    staged = []
+    written = []
+    try:
+        for z, info, target in plan:
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            part_path = target + '.incoming'
+            written.append(part_path)
+
+            # Copy in chunks - never the whole member in memory
+            with z.open(info) as src, open(part_path, 'wb') as dst:
+                while True:
+                    chunk = src.read(BACKUP_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    dst.write(chunk)
+                    with import_progress_lock:
+                        bytes_done = import_progress['bytes_done'] + len(chunk)
+                    _set_import_progress(bytes_done=bytes_done)
+
+            if info.filename in BACKUP_DATABASES:
+                # Only swap in databases that SQLite can actually read
+                conn = sqlite3.connect(part_path)
+                try:
+                    result = conn.execute('PRAGMA quick_check').fetchone()[0]
+                finally:
+                    conn.close()
+                if result != 'ok':
+                    raise ValueError(f"{info.filename} in the backup is damaged ({result})")
+                staged.append((part_path, target))
+            else:
+                os.replace(part_path, target)
+                written.remove(part_path)
+
+            _set_import_progress(files_done=import_progress['files_done'] + 1)
+
+        # Databases go in last, once everything else extracted cleanly
+        _set_import_progress(state='swapping')
+        swap_databases(staged)
+    except Exception as e:
+        for part_path in written:
+            if os.path.exists(part_path):
+                os.remove(part_path)
+        _set_import_progress(state='failed', error=str(e))
+        raise
+
+    _set_import_progress(state='done')
+    progress = get_import_progress()
+    print(f" * Restored {progress['files_done']} files from {len(archives)} archive(s) "
+          f"({progress['bytes_done'] / 1e6:.1f} MB) in {progress['elapsed']}s "
+          f"- {progress['mb_per_s']} MB/s")
+    return progress
+
+# --- LABEL ENGINE ---
+# Sheet profiles (all sizes in mm). L7651 is the original FilmLog layout.
+LABEL_SHEETS = {
+    'L7651': {
+        'name': 'Avery L7651 (65 per sheet)',
+        'columns': 5, 'rows': 13,
+        'label_width': 38, 'label_height': 21,
+        'margin_x': 10, 'margin_y': 12, 'gap_x': 2, 'gap_y': 0,
+        'font_size': 8, 'text_y': 14,
+        'barcode_y': 4, 'bar_height': 8, 'bar_width': 0.18,
+    },
+    'L7159': {
+        'name': 'Avery L7159 (24 per sheet)',
+        'columns': 3, 'rows': 8,
+        'label_width': 63.5, 'label_height': 33.9,
+        'margin_x': 7.2, 'margin_y': 12.9, 'gap_x': 2.5, 'gap_y': 0,
+        'font_size': 10, 'text_y': 23,
+        'barcode_y': 7, 'bar_height': 12, 'bar_width': 0.3,
+    },
+    'L7160': {
+        'name': 'Avery L7160 (21 per sheet)',
+        'columns': 3, 'rows': 7,
+        'label_width': 63.5, 'label_height': 38.1,
+        'margin_x': 7.2, 'margin_y': 15.1, 'gap_x': 2.5, 'gap_y': 0,
+        'font_size': 10, 'text_y': 26,
+        'barcode_y': 8, 'bar_height': 14, 'bar_width': 0.3,
+    },
+}
+DEFAULT_LABEL_SHEET = 'L7651'
+LABEL_FONT = 'Courier-Bold'
+LABEL_PREFIX = 'ROLL #'
+
+LABEL_CACHE_DIR = os.path.join(DATA_DIR, 'LabelCache')
+app.config['LABEL_CACHE_SIZE'] = 8  # Most recent PDFs kept on disk
+# Largest run one request may ask for (the form offers up to 100 L7651 sheets)
+app.config['LABEL_MAX_COUNT'] = 6500
+# Highest roll number a label may carry (parse_scan_code reads up to 9 digits)
+LABEL_MAX_NUMBER = 999999999
+
+def _pdf_num(value):
+    return f"{value:.2f}".rstrip('0').rstrip('.')
+
+def render_labels(profile_key, start_num, count):
+    """Generator yielding the PDF for `count` barcode labels starting at
+    `start_num`, one sheet at a time.
+
+    ReportLab's canvas only writes the file on save(), so the PDF objects are
+    written here directly: each page goes out as soon as it is drawn and the
+    cross-reference table follows at the end. ReportLab still supplies the
+    Code128 encoding and the font metrics.
+    """
+    from reportlab.lib.pagesizes import A4
+    from reportlab.lib.units import mm
+    from reportlab.pdfbase.pdfmetrics import stringWidth
+    from reportlab.graphics.barcode import code128
+
+    p = LABEL_SHEETS[profile_key]
+    width, height = A4
+
+    # 1. Everything that is the same on every sheet is worked out once
+    label_w, label_h = p['label_width'] * mm, p['label_height'] * mm
+    per_sheet = p['columns'] * p['rows']
+    # PDF draws from bottom-up, so we invert the row logic
+    slots = [(p['margin_x'] * mm + col * (label_w + p['gap_x'] * mm),
+              height - p['margin_y'] * mm - (row + 1) * (label_h + p['gap_y'] * mm))
+             for row in range(p['rows']) for col in range(p['columns'])]
+    font_size = p['font_size']
+    text_dy = p['text_y'] * mm
+    prefix_width = stringWidth(LABEL_PREFIX, LABEL_FONT, font_size)
+    text_widths = {}  # digits -> width of "ROLL #0001" (Courier is monospaced)
+
+    def text_x(slot_x, digits):
+        if digits not in text_widths:
+            text_widths[digits] = stringWidth(LABEL_PREFIX + '0' * digits, LABEL_FONT, font_size)
+        return slot_x + (label_w - text_widths[digits]) / 2
+
+    # One Code128 encoder for the whole run: only its value changes per label
+    barcode = code128.Code128('', barHeight=p['bar_height'] * mm, barWidth=p['bar_width'] * mm)
+    bar_w, bar_h, bar_dy = barcode.barWidth, barcode.barHeight, p['barcode_y'] * mm
 
-# 1. Define the DATA directory
-DATA_DIR = os.path.join(BASE_DIR, 'Data')
-if not os.path.exists(DATA_DIR):
-    os.makedirs(DATA_DIR)
+    def barcode_ops(value, slot_x, slot_y):
+        barcode.value = value
+        barcode.validate()
+        barcode.encode()
+        # Lower case = space, upper case = bar, letter = width in modules
+        modules = [(c.isupper(), ord(c.lower()) - ord('a') + 1) for c in barcode.decompose()]
+        total = sum(n for _, n in modules) * bar_w + barcode.lquiet + barcode.rquiet
+        left = slot_x + (label_w - total) / 2 + barcode.lquiet
+        y = _pdf_num(slot_y + bar_dy)
+        ops = []
+        for is_bar, n in modules:
+            if is_bar:
+                ops.append(f"{_pdf_num(left)} {y} {_pdf_num(n * bar_w)} {_pdf_num(bar_h)} re")
+            left += n * bar_w
+        return ops
 
-# 2. Define IMAGES directory (Data/Images)
-IMAGES_DIR = os.path.join(DATA_DIR, 'Images')
-if not os.path.exists(IMAGES_DIR):
-    os.makedirs(IMAGES_DIR)
+    # 2. PDF objects are numbered as they are written; the catalog (1) and the
+    # page tree (2) are written last, once all the page numbers are known
+    offsets = {}
+    written = 0
+    page_ids = []
+    next_id = 4  # 3 = the font
 
-# 3. Database Config
-# Main DB (Film Log)
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(DATA_DIR, 'filmlog.db')
+    def pdf_object(obj_id, body, stream=None):
+        nonlocal written
+        offsets[obj_id] = written
+        if stream is not None:
+            stream = zlib.compress(stream.encode('latin-1'))
+            body = body[:-2] + f" /Filter /FlateDecode /Length {len(stream)} >>"
+            data = f"{obj_id} 0 obj\n{body}\nstream\n".encode('latin-1') + stream + b"\nendstream\nendobj\n"
+        else:
+            data = f"{obj_id} 0 obj\n{body}\nendobj\n".encode('latin-1')
+        written += len(data)
+        return data
 
-# New DB (Gear Log) - Binds allows multiple DB files
-app.config['SQLALCHEMY_BINDS'] = {
-    'gear': 'sqlite:///' + os.path.join(DATA_DIR, 'gearlog.db')
+    def new_id():
+        nonlocal next_id
+        next_id += 1
+        return next_id - 1
+
+    header = b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n"
+    written = len(header)
+    yield header + pdf_object(3, f"<< /Type /Font /Subtype /Type1 /BaseFont /{LABEL_FONT} "
+                                 "/Encoding /WinAnsiEncoding >>")
+
+    # 3. The "ROLL #" prefixes of a full sheet go into a PDF form XObject:
+    # stored once in the file and stamped onto each page with one operator
+    forms = {}  # digits -> object id
+
+    def prefix_form(digits):
+        ops = ["BT", f"/F1 {font_size} Tf"]
+        for x, y in slots:
+            ops.append(f"1 0 0 1 {_pdf_num(text_x(x, digits))} {_pdf_num(y + text_dy)} Tm ({LABEL_PREFIX}) Tj")
+        ops.append("ET")
+        forms[digits] = new_id()
+        return pdf_object(forms[digits],
+                          f"<< /Type /XObject /Subtype /Form /BBox [0 0 {_pdf_num(width)} {_pdf_num(height)}] "
+                          "/Resources << /Font << /F1 3 0 R >> >> >>", '\n'.join(ops))
+
+    # 4. Per label only the number and its barcode are drawn
+    for page_start in range(0, count, per_sheet):
+        on_page = min(per_sheet, count - page_start)
+        first = start_num + page_start
+        last = first + on_page - 1
+        digits_first, digits_last = len(f"{first:04d}"), len(f"{last:04d}")
+
+        chunk = b''
+        use_form = on_page == per_sheet and digits_first == digits_last
+        text_ops, bar_ops = ["BT", f"/F1 {font_size} Tf"], []
+        resources = "/Font << /F1 3 0 R >>"
+        if use_form:
+            if digits_first not in forms:
+                chunk += prefix_form(digits_first)
+            resources += f" /XObject << /Prefixes {forms[digits_first]} 0 R >>"
+
+        for i in range(on_page):
+            roll_id_str = f"{first + i:04d}"
+            x, y = slots[i]
+            tx = text_x(x, len(roll_id_str))
+            if use_form:
+                text = f"{_pdf_num(tx + prefix_width)} {_pdf_num(y + text_dy)} Tm ({roll_id_str}) Tj"
+            else:
+                text = f"{_pdf_num(tx)} {_pdf_num(y + text_dy)} Tm ({LABEL_PREFIX}{roll_id_str}) Tj"
+            text_ops.append("1 0 0 1 " + text)
+            # Barcode (Code128) - centered
+            bar_ops.extend(barcode_ops(roll_id_str, x, y))
+        text_ops.append("ET")
+
+        content = (["/Prefixes Do"] if use_form else []) + text_ops + ["0 g"] + bar_ops + ["f"]
+        content_id, page_id = new_id(), new_id()
+        page_ids.append(page_id)
+        chunk += pdf_object(content_id, "<< >>", '\n'.join(content))
+        chunk += pdf_object(page_id, f"<< /Type /Page /Parent 2 0 R "
+                                     f"/MediaBox [0 0 {_pdf_num(width)} {_pdf_num(height)}] "
+                                     f"/Resources << {resources} >> /Contents {content_id} 0 R >>")
+        yield chunk
+
+    # 5. Page tree, catalog and the cross-reference table
+    kids = ' '.join(f"{page_id} 0 R" for page_id in page_ids)
+    chunk = pdf_object(2, f"<< /Type /Pages /Kids [{kids}] /Count {len(page_ids)} >>")
+    chunk += pdf_object(1, "<< /Type /Catalog /Pages 2 0 R >>")
+    xref = [f"xref\n0 {next_id}\n0000000000 65535 f \n"]
+    xref += [f"{offsets[obj_id]:010d} 00000 n \n" for obj_id in range(1, next_id)]
+    xref.append(f"trailer\n<< /Size {next_id} /Root 1 0 R >>\nstartxref\n{written}\n%%EOF\n")
+    yield chunk + ''.join(xref).encode('latin-1')
+
+def label_pdf_response(profile_key, start_num, count, download_name):
+    """Sends the PDF for this range from the on-disk cache, or streams it to
+    the client while it is rendered (and written to the cache as it goes)."""
+    os.makedirs(LABEL_CACHE_DIR, exist_ok=True)
+    path = os.path.join(LABEL_CACHE_DIR, f"labels_{profile_key}_{start_num}_{count}.pdf")
+
+    if os.path.exists(path):
+        os.utime(path)  # Mark as recently used
+        metrics.inc('filmlog_label_cache_total', result='hit')
+        return send_file(path, as_attachment=True, download_name=download_name, mimetype='application/pdf')
+    metrics.inc('filmlog_label_cache_total', result='miss')
+
+    def generate():
+        # Written to a temp file first so a half-written PDF (client gone
+        # mid-download) is never cached
+        fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=LABEL_CACHE_DIR)
+        complete = False
+        try:
+            started = time.perf_counter()
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in render_labels(profile_key, start_num, count):
+                    f.write(chunk)
+                    yield chunk
+            metrics.observe('filmlog_label_render_seconds', time.perf_counter() - started)
+            os.replace(tmp_path, path)
+            complete = True
+        finally:
+            if not complete:
+                os.remove(tmp_path)
+        prune_label_cache()
+
+    return Response(generate(), mimetype='application/pdf',
+                    headers={'Content-Disposition': f'attachment; filename="{download_name}"'})
+
+def prune_label_cache():
+    # Keep only the most recent few
+    cached = sorted((os.path.join(LABEL_CACHE_DIR, f) for f in os.listdir(LABEL_CACHE_DIR) if f.endswith('.pdf')),
+                    key=os.path.getmtime, reverse=True)
+    for old in cached[app.config['LABEL_CACHE_SIZE']:]:
+        try:
+            os.remove(old)
+        except OSError:
+            pass
+
+# --- METRICS (/metrics, Prometheus text format) ---
+# Request hooks time every route and SQLAlchemy cursor events count and
+# time every query. Everything is kept in memory for this process only.
+# Slow requests/queries are printed to the console (0 disables the log).
+app.config['SLOW_REQUEST_MS'] = 1000
+app.config['SLOW_QUERY_MS'] = 200
+
+METRIC_BUCKETS = {
+    'filmlog_request_duration_seconds': [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10],
+    'filmlog_request_queries': [0, 1, 2, 5, 10, 20, 50, 100],
+    'filmlog_request_query_seconds': [0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5],
+    'filmlog_db_query_seconds': [0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1],
+    'filmlog_image_processing_seconds': [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30],
+    'filmlog_label_render_seconds': [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10],
+    'filmlog_similar_search_seconds': [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5],
+}
+METRIC_HELP = {
+    'filmlog_requests_total': ('counter', 'HTTP requests by route and status'),
+    'filmlog_request_duration_seconds': ('histogram', 'Time to build the response, per route'),
+    'filmlog_request_queries': ('histogram', 'SQL queries run per request'),
+    'filmlog_request_query_seconds': ('histogram', 'Time spent in SQL per request'),
+    'filmlog_db_query_seconds': ('histogram', 'Duration of single SQL statements'),
+    'filmlog_slow_requests_total': ('counter', 'Requests slower than SLOW_REQUEST_MS'),
+    'filmlog_slow_queries_total': ('counter', 'Queries slower than SLOW_QUERY_MS'),
+    'filmlog_image_processing_seconds': ('histogram', 'Contact sheet optimisation time (worker side)'),
+    'filmlog_image_jobs_total': ('counter', 'Finished image jobs by result'),
+    'filmlog_label_render_seconds': ('histogram', 'Label PDF render time (cache misses)'),
+    'filmlog_label_cache_total': ('counter', 'Label PDF requests by cache result'),
+    'filmlog_similar_search_seconds': ('histogram', 'Find-similar index lookup time'),
+    'filmlog_active_requests': ('gauge', 'Requests in flight'),
+    'filmlog_image_jobs_queued': ('gauge', 'Image jobs waiting or running'),
+    'filmlog_start_time_seconds': ('gauge', 'Unix time the process started'),
 }
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
-# 4. Upload Config (Lives in Data/Images)
-app.config['UPLOAD_FOLDER'] = IMAGES_DIR
-app.config['ALLOWED_EXTENSIONS'] = {'jpg', 'jpeg', 'png'}
+def _metric_labels(labels):
+    if not labels:
+        return ''
+    def escape(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{' + ','.join(f'{k}="{escape(v)}"' for k, v in labels) + '}'
 
-# Ensure upload directory exists
-os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}    # (name, labels) -> value
+        self.histograms = {}  # (name, labels) -> [count per bucket..., sum, count]
+        self.started = time.time()
 
-db = SQLAlchemy(app)
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
 
-# DATABASE MODELS
-class Roll(db.Model):
-    id = db.Column(db.Integer, primary_key=True) 
-    film_type = db.Column(db.String(100), nullable=False)
-    iso = db.Column(db.Integer)            
-    camera = db.Column(db.String(100))
-    lens = db.Column(db.String(100))
-    date_started = db.Column(db.Date)
-    date_finished = db.Column(db.Date)
-    date_added = db.Column(db.DateTime, default=datetime.utcnow)
-    contact_sheet = db.Column(db.String(200)) 
-    notes = db.Column(db.Text)
-    
-    @property
-    def formatted_id(self):
-        """Returns ID as 0001 string"""
-        return f"{self.id:04d}"
-        
- # Settings for GearLog       
-class Gear(db.Model):
-    __bind_key__ = 'gear'  # Tells Flask to save this in gearlog.db
-    id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(100), nullable=False) # e.g. "Canon AE-1"
-    hardware_type = db.Column(db.String(50), nullable=False) # Camera, Lens, etc
-    serial_number = db.Column(db.String(100))
-    date_added = db.Column(db.DateTime, default=datetime.utcnow)
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        buckets = METRIC_BUCKETS[name]
+        with self.lock:
+            hist = self.histograms.get(key)
+            if hist is None:
+                hist = self.histograms[key] = [0] * len(buckets) + [0.0, 0]
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    hist[i] += 1
+                    break
+            hist[-2] += value
+            hist[-1] += 1
 
-class AppSetting(db.Model):
-    # Stores global app preferences
-    id = db.Column(db.Integer, primary_key=True)
-    key = db.Column(db.String(50), unique=True, nullable=False)
-    value = db.Column(db.String(50)) # "true" or "false"
-# HELPER FUNCTIONS
-def allowed_file(filename):
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in app.config['ALLOWED_EXTENSIONS']
+    def render(self, gauges=()):
+        """Prometheus text exposition (version 0.0.4)"""
+        with self.lock:
+            samples = {}
+            for (name, labels), value in self.counters.items():
+                samples.setdefault(name, []).append(f'{name}{_metric_labels(labels)} {value}')
+            for (name, labels), hist in self.histograms.items():
+                lines = samples.setdefault(name, [])
+                cumulative = 0
+                for bound, bucket_count in zip(METRIC_BUCKETS[name], hist):
+                    cumulative += bucket_count
+                    lines.append(f'{name}_bucket{_metric_labels(labels + (("le", bound),))} {cumulative}')
+                lines.append(f'{name}_bucket{_metric_labels(labels + (("le", "+Inf"),))} {hist[-1]}')
+                lines.append(f'{name}_sum{_metric_labels(labels)} {hist[-2]:.6f}')
+                lines.append(f'{name}_count{_metric_labels(labels)} {hist[-1]}')
+        for name, value in gauges:
+            samples.setdefault(name, []).append(f'{name} {value}')
 
-# NEW: Image Optimization Function
-def save_optimized_image(file_storage, filename):
-    filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-    
-    # Open the image using Pillow
-    img = Image.open(file_storage)
-    
-    # 1. Convert to RGB (Fixes issues with some PNGs/TIFFs when saving as JPEG)
-    if img.mode in ("RGBA", "P"):
-        img = img.convert("RGB")
-        
-    # 2. Resize to fit within 4K Box (3840x2160)
-    # 'thumbnail' modifies the image in-place and PRESERVES ASPECT RATIO.
-    # It will never stretch or crop; it just shrinks it until it fits.
-    img.thumbnail((3840, 2160), Image.Resampling.LANCZOS)
-    
-    # 3. Save with optimization
-    # quality=85 reduces file size by ~60-80% with no visible quality loss
-    img.save(filepath, optimize=True, quality=85)
+        out = []
+        for name in sorted(samples):
+            kind, help_text = METRIC_HELP.get(name, ('untyped', ''))
+            out.append(f'# HELP {name} {help_text}')
+            out.append(f'# TYPE {name} {kind}')
+            out.extend(samples[name])
+        return '\n'.join(out) + '\n'
+
+metrics = Metrics()
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    conn.info['query_started'] = time.perf_counter()
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def record_query(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.pop('query_started', None)
+    if started is None:
+        return
+    elapsed = time.perf_counter() - started
+    metrics.observe('filmlog_db_query_seconds', elapsed, db=os.path.basename(conn.engine.url.database or ''))
+    if has_request_context():
+        g.query_count = g.get('query_count', 0) + 1
+        g.query_time = g.get('query_time', 0.0) + elapsed
+
+    slow_ms = app.config['SLOW_QUERY_MS']
+    if slow_ms and elapsed * 1000 >= slow_ms:
+        metrics.inc('filmlog_slow_queries_total')
+        print(f" * Slow query ({elapsed * 1000:.0f} ms): {' '.join(statement.split())[:300]}")
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    g.query_count = 0
+    g.query_time = 0.0
+
+# Registered before the compression hook, so it runs after it (and counts it)
+@app.after_request
+def record_request(response):
+    started = g.get('request_started')
+    if started is None:
+        return response
+    elapsed = time.perf_counter() - started
+    endpoint = request.endpoint or 'unmatched'
+    metrics.inc('filmlog_requests_total', endpoint=endpoint, method=request.method, status=response.status_code)
+    metrics.observe('filmlog_request_duration_seconds', elapsed, endpoint=endpoint, method=request.method)
+    metrics.observe('filmlog_request_queries', g.query_count, endpoint=endpoint)
+    metrics.observe('filmlog_request_query_seconds', g.query_time, endpoint=endpoint)
+
+    slow_ms = app.config['SLOW_REQUEST_MS']
+    if slow_ms and elapsed * 1000 >= slow_ms:
+        metrics.inc('filmlog_slow_requests_total', endpoint=endpoint)
+        print(f" * Slow request ({elapsed * 1000:.0f} ms): {request.method} {request.full_path.rstrip('?')} "
+              f"-> {response.status_code}, {g.query_count} queries in {g.query_time * 1000:.0f} ms")
+    return response
+
+# --- HTTP CACHING & COMPRESSION ---
+# Uploaded images are named after the hash of their content (see IMAGE
+# STORE), so such a name never gets new content: they and their thumbnails
+# are served as immutable. Old timestamp-named files can be rewritten by a
+# restore, so they get a short max-age and are revalidated with their ETag.
+# Static files get a ?v=<hash> fingerprint in url_for() so they can be
+# cached just as long. HTML/CSS/JS/JSON are gzip or brotli compressed
+# (brotli only if the module is installed).
+app.config['IMAGE_MAX_AGE'] = 365 * 24 * 3600
+app.config['LEGACY_IMAGE_MAX_AGE'] = 3600
+app.config['STATIC_MAX_AGE'] = 365 * 24 * 3600
+app.config['COMPRESS_MIMETYPES'] = {'text/html', 'text/css', 'text/plain', 'application/javascript',
+                                    'application/json', 'image/svg+xml'}
+app.config['COMPRESS_MIN_SIZE'] = 500
+
+static_fingerprints = {}  # filename -> (mtime, hash)
+static_compressed = {}    # (filename, mtime, encoding) -> bytes
+
+def static_fingerprint(filename):
+    path = os.path.join(app.static_folder, filename)
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return None
+    cached = static_fingerprints.get(filename)
+    if not cached or cached[0] != mtime:
+        with open(path, 'rb') as f:
+            cached = (mtime, hashlib.sha1(f.read()).hexdigest()[:10])
+        static_fingerprints[filename] = cached
+    return cached[1]
+
+@app.url_defaults
+def add_static_fingerprint(endpoint, values):
+    if endpoint == 'static' and 'filename' in values and 'v' not in values:
+        fingerprint = static_fingerprint(values['filename'])
+        if fingerprint:
+            values['v'] = fingerprint
+
+def image_response(directory, filename, immutable=True, max_age=0):
+    # Strong ETag + Range requests come from send_file's conditional mode
+    if not immutable:
+        # Temporary stand-in (raw upload, missing thumbnail) or legacy name:
+        # revalidated with the ETag once max_age runs out
+        return send_from_directory(directory, filename, max_age=max_age)
+    response = send_from_directory(directory, filename, max_age=app.config['IMAGE_MAX_AGE'])
+    response.cache_control.immutable = True
+    return response
+
+def stored_image_response(directory, name, source):
+    """Sends `name` (the image `source` or one of its thumbnails)"""
+    if HASHED_IMAGE_RE.match(source):
+        return image_response(directory, name)
+    return image_response(directory, name, immutable=False, max_age=app.config['LEGACY_IMAGE_MAX_AGE'])
+
+def compress(data, encoding, static=False):
+    if encoding == 'br':
+        return brotli.compress(data, quality=11 if static else 5)
+    return gzip.compress(data, compresslevel=9 if static else 6, mtime=0)
+
+def response_encoding():
+    accepted = request.accept_encodings
+    if brotli is not None and accepted['br']:
+        return 'br'
+    if accepted['gzip']:
+        return 'gzip'
+    return None
+
+@app.after_request
+def cache_and_compress(response):
+    # 1. Cache policy for static files (fingerprinted URLs never change)
+    if request.endpoint == 'static':
+        if request.args.get('v'):
+            response.cache_control.no_cache = None
+            response.cache_control.public = True
+            response.cache_control.max_age = app.config['STATIC_MAX_AGE']
+            response.cache_control.immutable = True
+        else:
+            response.cache_control.no_cache = True
+
+    if response.mimetype not in app.config['COMPRESS_MIMETYPES']:
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = response_encoding()
+    if (request.method != 'GET' or response.status_code != 200 or encoding is None
+            or response.is_streamed and request.endpoint != 'static'
+            or 'Content-Encoding' in response.headers
+            or (response.content_length or 0) < app.config['COMPRESS_MIN_SIZE']):
+        return response
+
+    # 2. Compress: static files once per version, pages per response
+    if request.endpoint == 'static':
+        filename = request.view_args['filename']
+        key = (filename, os.path.getmtime(os.path.join(app.static_folder, filename)), encoding)
+        if key not in static_compressed:
+            with open(os.path.join(app.static_folder, filename), 'rb') as f:
+                static_compressed[key] = compress(f.read(), encoding, static=True)
+        body = static_compressed[key]
+        etag, _ = response.get_etag()
+        response.close()
+        response.direct_passthrough = False
+        response.set_data(body)
+        # Each encoding is a different representation - it gets its own ETag
+        response.set_etag(f'{etag}-{encoding}')
+    else:
+        response.set_data(compress(response.get_data(), encoding))
+        etag, weak = response.get_etag()
+        if etag and not weak:
+            # Set by the view (JSON API): same content, so still a valid weak match
+            response.set_etag(etag, weak=True)
+        if response.mimetype == 'text/html':
+            # Pages are rendered per request: cacheable only after revalidation
+            response.add_etag()
+            response.cache_control.no_cache = True
+    response.headers['Content-Encoding'] = encoding
+    return response.make_conditional(request)
+
+# --- STARTUP (template precompile + import profile) ---
+def precompile_templates():
+    """Compiles every template into the bytecode cache. Returns how many."""
+    count = 0
+    for name in app.jinja_env.list_templates(extensions=['html']):
+        app.jinja_env.get_template(name)
+        count += 1
+    return count
+
+@app.cli.command('precompile-templates')
+def precompile_templates_command():
+    """Fills Data/TemplateCache so the next start skips Jinja compilation."""
+    if not app.config['TEMPLATE_CACHE_DIR']:
+        raise click.UsageError('TEMPLATE_CACHE_DIR is disabled')
+    started = time.perf_counter()
+    count = precompile_templates()
+    click.echo(f" * Compiled {count} templates in {(time.perf_counter() - started) * 1000:.0f} ms "
+               f"-> {app.config['TEMPLATE_CACHE_DIR']}")
+
+# Runs in a fresh interpreter so nothing is imported yet
+STARTUP_PROFILE_SCRIPT = """
+import json, sys, time
+started = time.perf_counter()
+import app as filmlog
+imported = time.perf_counter()
+with filmlog.app.app_context():
+    filmlog.init_database()
+ready = time.perf_counter()
+response = filmlog.app.test_client().get('/')
+first_page = time.perf_counter()
+print(json.dumps({
+    'import_ms': (imported - started) * 1000,
+    'init_ms': (ready - imported) * 1000,
+    'first_page_ms': (first_page - ready) * 1000,
+    'status': response.status_code,
+    'heavy_loaded': [m for m in ('reportlab', 'PIL') if m in sys.modules],
+}))
+"""
+
+@app.cli.command('profile-startup')
+@click.option('--top', default=15, help='How many modules to list.')
+def profile_startup(top):
+    """Reports the import cost per module of a cold start (python -X importtime)."""
+    if getattr(sys, 'frozen', False):
+        raise click.UsageError('Run this from a Python install, not the EXE')
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', STARTUP_PROFILE_SCRIPT],
+                            cwd=BASE_DIR, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise click.ClickException(result.stderr.strip().splitlines()[-1])
+
+    # 1. "import time: self [us] | cumulative | name" - add up the self time
+    #    of every module per top-level package (app = app.py's own body)
+    packages = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, _, name = line[len('import time:'):].split('|')
+        package = name.strip().split('.')[0]
+        packages[package] = packages.get(package, 0) + int(self_us)
+
+    summary = json.loads(result.stdout.strip().splitlines()[-1])
+    click.echo(f" * import app: {summary['import_ms']:.0f} ms, init_database: {summary['init_ms']:.0f} ms, "
+               f"first page: {summary['first_page_ms']:.0f} ms (HTTP {summary['status']})")
+    click.echo(f" * Heavy modules loaded by then: {', '.join(summary['heavy_loaded']) or 'none'}")
+    click.echo(f" * Top {top} packages by import time:")
+    for package, micros in sorted(packages.items(), key=lambda item: item[1], reverse=True)[:top]:
+        click.echo(f"   {micros / 1000:8.1f} ms  {package}")
+
+# --- SERVER (Production mode + graceful shutdown) ---
+# Requests in flight (including streamed downloads) and the drain flag.
+# The counter lives in WSGI middleware so a streamed backup still counts
+# until its last byte is sent.
+server_state = {'active': 0, 'draining': False}
+server_state_lock = threading.Lock()
+
+class RequestTracker:
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        with server_state_lock:
+            if server_state['draining']:
+                start_response('503 Service Unavailable', [('Content-Type', 'text/plain'), ('Retry-After', '10')])
+                return [b'FilmLog is shutting down.']
+            server_state['active'] += 1
+        try:
+            iterable = self.wsgi_app(environ, start_response)
+        except Exception:
+            self._finished()
+            raise
+        return ClosingIterator(iterable, [self._finished])
+
+    def _finished(self):
+        with server_state_lock:
+            server_state['active'] -= 1
+
+app.wsgi_app = RequestTracker(app.wsgi_app)
+
+def graceful_shutdown(timeout=30):
+    """Stops taking requests, lets running ones finish, closes the DBs, then stops the server."""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        with server_state_lock:
+            if server_state['active'] == 0:
+                break
+        time.sleep(0.1)
+
+    # Running image jobs finish; queued ones stay in the DB for next start
+    with image_pool_lock:
+        if image_pool is not None:
+            image_pool.shutdown(wait=True, cancel_futures=True)
+
+    # Close every connection (this also checkpoints the WAL into the .db files)
+    with app.app_context():
+        db.session.remove()
+        for engine in db.engines.values():
+            engine.dispose()
+    settings.invalidate()
+
+    print(" * FilmLog stopped")
+    # Both waitress and the Werkzeug server return from their loop on Ctrl+C
+    _thread.interrupt_main()
+
+def run_server(host, port):
+    # Settings live in filmlog.db - read them inside an app context
+    with app.app_context():
+        mode = settings.get('server_mode')
+        threads = min(max(settings.get('server_threads'), SERVER_THREADS_RANGE[0]), SERVER_THREADS_RANGE[1])
+        connections = min(max(settings.get('server_connections'), SERVER_CONNECTIONS_RANGE[0]), SERVER_CONNECTIONS_RANGE[1])
+    app.config['RUNNING_MODE'] = mode
+    app.config['RUNNING_THREADS'] = threads
+    app.config['RUNNING_CONNECTIONS'] = connections
+
+    if mode == 'development':
+        app.run(debug=True, host=host, port=port)
+        return
+
+    try:
+        from waitress import serve
+    except ImportError:
+        # waitress not bundled - the threaded Werkzeug server is the next best thing
+        print(" * waitress not installed, using the built-in threaded server")
+        from werkzeug.serving import make_server
+        server = make_server(host, port, app, threaded=True)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+        return
+
+    print(f" * Production server: {threads} threads, {connections} connections")
+    serve(app, host=host, port=port, threads=threads, connection_limit=connections,
+          ident='FilmLog')
 
 # ROUTES
 # Makes 'gear_enabled' variable available to ALL templates automatically
 
 @app.route('/shutdown', methods=['POST'])
 def shutdown():
-    # Force the application to exit
-    os._exit(0)
+    # Drain and stop in the background so this response can still be sent
+    with server_state_lock:
+        already = server_state['draining']
+        server_state['draining'] = True
+    if not already:
+        threading.Thread(target=graceful_shutdown, daemon=True).start()
+    return "FilmLog is shutting down. You can close this window."
 
 @app.route('/save_advanced', methods=['POST'])
 def save_advanced():
     # 1. Get Form Data
     port = request.form.get('server_port', '5000')
     host_type = request.form.get('server_host') # 'local' or 'network'
+    mode = 'development' if request.form.get('server_mode') == 'development' else 'production'
     
     # 2. Determine IP Address
     # '0.0.0.0' = Available to whole network
     # '127.0.0.1' = Localhost only (Private)
     new_host = '0.0.0.0' if host_type == 'network' else '127.0.0.1'
     
-    # 3. Save Port
-    p_setting = AppSetting.query.filter_by(key='server_port').first()
-    if not p_setting:
-        p_setting = AppSetting(key='server_port', value=port)
-        db.session.add(p_setting)
-    else:
-        p_setting.value = port
-        
-    # 4. Save Host
-    h_setting = AppSetting.query.filter_by(key='server_host').first()
-    if not h_setting:
-        h_setting = AppSetting(key='server_host', value=new_host)
-        db.session.add(h_setting)
-    else:
-        h_setting.value = new_host
+    # 3. Worker threads / connection limit (kept within sane bounds)
+    def bounded(name, default, limits):
+        try:
+            value = int(request.form.get(name, default))
+        except ValueError:
+            value = default
+        return str(min(max(value, limits[0]), limits[1]))
+    
+    threads = bounded('server_threads', SETTING_TYPES['server_threads'][1], SERVER_THREADS_RANGE)
+    connections = bounded('server_connections', SETTING_TYPES['server_connections'][1], SERVER_CONNECTIONS_RANGE)
+    
+    # 4. Save everything
+    values = {'server_port': port, 'server_host': new_host, 'server_mode': mode,
+              'server_threads': threads, 'server_connections': connections}
+    for key, value in values.items():
+        setting = AppSetting.query.filter_by(key=key).first()
+        if not setting:
+            setting = AppSetting(key=key, value=value)
+            db.session.add(setting)
+        else:
+            setting.value = value
         
     db.session.commit()
+    settings.invalidate()
     
     return redirect(url_for('preferences'))
 
@@ -154,16 +2950,12 @@ def save_advanced():
 # Makes variables available to ALL templates automatically
 @app.context_processor
 def inject_globals():
-    # 1. Gear Setting
-    gear_setting = AppSetting.query.filter_by(key='enable_gearlog').first()
-    is_enabled = gear_setting.value == 'true' if gear_setting else False
-    
-    # 2. Network Settings (Get value from DB)
-    port_setting = AppSetting.query.filter_by(key='server_port').first()
-    db_port = port_setting.value if port_setting else '5000'  # <--- Defined as db_port
+    # 1. Gear Setting (from the in-memory settings cache, no DB query)
+    is_enabled = settings.get('enable_gearlog')
     
-    host_setting = AppSetting.query.filter_by(key='server_host').first()
-    db_host = host_setting.value if host_setting else '0.0.0.0' # <--- Defined as db_host
+    # 2. Network Settings (Saved value - may differ from what is running)
+    db_port = settings.get('server_port')
+    db_host = settings.get('server_host')
     
     # 3. CHECK FOR PENDING RESTART
     # Compare DB (Future) vs Running (Current)
@@ -176,10 +2968,19 @@ def inject_globals():
     if str(db_host) != str(app.config.get('RUNNING_HOST', '0.0.0.0')):
         pending_changes = True
     
+    server_values = {key: settings.get(key) for key in ('server_mode', 'server_threads', 'server_connections')}
+    for key, value in server_values.items():
+        running = app.config.get('RUNNING_' + key.split('_', 1)[1].upper())
+        if running is not None and str(value) != str(running):
+            pending_changes = True
+    
     # Return using the keys the template expects
     return dict(gear_enabled=is_enabled, 
                 current_port=db_port, 
                 current_host=db_host, 
+                current_mode=server_values['server_mode'],
+                current_threads=server_values['server_threads'],
+                current_connections=server_values['server_connections'],
                 pending_changes=pending_changes)
     
     # --- GEAR ROUTES ---
@@ -187,11 +2988,11 @@ def inject_globals():
 @app.route('/gear')
 def gear_index():
     # Security check: if disabled, kick them back home
-    setting = AppSetting.query.filter_by(key='enable_gearlog').first()
-    if not setting or setting.value != 'true':
+    if not settings.get('enable_gearlog'):
         return redirect(url_for('index'))
         
-    gear_list = Gear.query.order_by(Gear.hardware_type.asc(), Gear.name.asc()).all()
+    # Items with their roll counts / last use - one query over both DB files
+    gear_list = gear_usage()
     return render_template('gear.html', gear_list=gear_list)
 
 @app.route('/gear/add', methods=['GET', 'POST'])
@@ -204,6 +3005,7 @@ def add_gear():
         new_gear = Gear(name=name, hardware_type=hw_type, serial_number=serial)
         db.session.add(new_gear)
         db.session.commit()
+        relink_rolls()
         return redirect(url_for('gear_index'))
         
     return render_template('add_gear.html')
@@ -213,6 +3015,7 @@ def delete_gear(id):
     item = Gear.query.get_or_404(id)
     db.session.delete(item)
     db.session.commit()
+    unlink_gear(id)
     return redirect(url_for('gear_index'))
 
 # --- SETTINGS ROUTE (For the Toggle) ---
@@ -232,28 +3035,82 @@ def toggle_feature(feature_key):
             setting.value = 'true'
             
     db.session.commit()
+    settings.invalidate()
     return redirect(url_for('preferences'))
 
 @app.route('/', methods=['GET', 'POST'])
 def index():
     search_query = request.args.get('q', '')
     results = []
+    page = None
     
     if search_query:
         # Check if search is a Roll ID (e.g., 0004 or 4)
         if search_query.isdigit():
             results = Roll.query.filter_by(id=int(search_query)).all()
         else:
-            # Search by Film Type or Camera (partial match)
-            results = Roll.query.filter(
-                (Roll.film_type.contains(search_query)) | 
-                (Roll.camera.contains(search_query))
-            ).all()
+            # Full-text search (Film, Camera, Lens, Notes - prefix aware),
+            # best matches first, one page at a time
+            query, relevance = search_roll_query(search_query)
+            page = paginate_rolls(query, relevance, descending=False,
+                                  after=request.args.get('after'), before=request.args.get('before'),
+                                  per_page=app.config['SEARCH_PAGE_SIZE'])
+            results = page['rolls']
     else:
         # Show recent 5 rolls if no search
         results = Roll.query.order_by(Roll.id.desc()).limit(5).all()
 
-    return render_template('index.html', results=results, search_query=search_query)
+    return render_template('index.html', results=results, search_query=search_query, page=page)
+
+# Audit a box: scan many canisters, resolve them in batches (see SCAN SESSIONS)
+@app.route('/scan')
+def scan_session():
+    return render_template('scan.html', batch_limit=app.config['API_BATCH_LIMIT'])
+
+@app.route('/scan/export', methods=['POST'])
+def export_scan_session():
+    # The page posts every scanned code, one per line, in scan order
+    codes = [line for line in request.form.get('codes', '').splitlines() if line.strip()]
+    codes = codes[:app.config['SCAN_SESSION_LIMIT']]
+    entries, invalid = resolve_scans(codes)
+
+    out = io.StringIO()
+    writer = csv.DictWriter(out, fieldnames=SCAN_EXPORT_FIELDS, extrasaction='ignore')
+    writer.writeheader()
+    for entry in entries:
+        writer.writerow(dict(entry, roll_id=entry['formatted_id'], times_scanned=entry['scans']))
+    for code in invalid:
+        writer.writerow({'roll_id': code, 'status': 'invalid', 'times_scanned': 1})
+
+    filename = f"FilmLog_Scan_{datetime.now().strftime('%Y-%m-%d_%H%M')}.csv"
+    return Response(out.getvalue(), mimetype='text/csv',
+                    headers={'Content-Disposition': f'attachment; filename="{filename}"'})
+
+# Browse the whole archive, e.g. /rolls?sort=camera&dir=asc
+@app.route('/rolls')
+def roll_list():
+    sort = request.args.get('sort', 'id')
+    if sort not in ROLL_SORTS:
+        sort = 'id'
+    direction = 'asc' if request.args.get('dir') == 'asc' else 'desc'
+    try:
+        per_page = min(max(int(request.args.get('per_page', app.config['ROLLS_PAGE_SIZE'])), 1), 200)
+    except ValueError:
+        per_page = app.config['ROLLS_PAGE_SIZE']
+
+    # /rolls?gear=<id>: only the rolls shot with one gear item
+    query = Roll.query
+    gear = None
+    gear_id = request.args.get('gear', type=int)
+    if gear_id is not None:
+        gear = db.session.get(Gear, gear_id)
+        query = query.filter((Roll.camera_gear_id == gear_id) | (Roll.lens_gear_id == gear_id))
+
+    page = paginate_rolls(query, ROLL_SORTS[sort], descending=(direction == 'desc'),
+                          after=request.args.get('after'), before=request.args.get('before'),
+                          per_page=per_page)
+    return render_template('rolls.html', page=page, sort=sort, direction=direction, per_page=per_page,
+                           gear=gear, gear_id=gear_id)
 
 @app.route('/add', methods=['GET', 'POST'])
 def add_roll():
@@ -261,10 +3118,7 @@ def add_roll():
     last_roll = db.session.query(func.max(Roll.id)).scalar() or 0
     next_id = last_roll + 1
     
-    # Autocomplete Lists
-    existing_films = [r.film_type for r in db.session.query(Roll.film_type).distinct()]
-    existing_cameras = [r.camera for r in db.session.query(Roll.camera).distinct()]
-    existing_lenses = [r.lens for r in db.session.query(Roll.lens).distinct() if r.lens]
+    # (Autocomplete comes from /api/suggest - no lists embedded in the page)
 
     if request.method == 'POST':
         # 1. Get the Custom Roll ID
@@ -274,10 +3128,9 @@ def add_roll():
             custom_id = next_id
 
         # 2. VALIDATION: Check if this ID is already taken
-        if Roll.query.get(custom_id):
+        if roll_id_taken(custom_id):
             error_msg = f"⚠️ Error: Roll #{custom_id:04d} already exists in the database."
-            return render_template('add_roll.html', error=error_msg, next_id=next_id,
-                                   films=existing_films, cameras=existing_cameras, lenses=existing_lenses)
+            return render_template('add_roll.html', error=error_msg, next_id=next_id)
 
         # 3. Get Other Data
         film_type = request.form['film_type']
@@ -285,27 +3138,18 @@ def add_roll():
         lens = request.form.get('lens')
         notes = request.form['notes']
         
-        iso_input = request.form.get('iso')
-        iso = int(iso_input) if iso_input else None
+        iso = parse_iso(request.form.get('iso'))
         
-        # Date Logic
-        def parse_date(date_str):
-            if date_str:
-                try:
-                    return datetime.strptime(date_str, '%Y-%m-%d').date()
-                except ValueError:
-                    return None
-            return None
-
+        # Date Logic (see ROLL VALIDATION)
         date_started = parse_date(request.form.get('date_started'))
         date_finished = parse_date(request.form.get('date_finished'))
         
-        # Image Upload
+        # Image Upload (optimised in the background)
         file = request.files['contact_sheet']
         filename = None
+        job = None
         if file and allowed_file(file.filename):
-            filename = secure_filename(f"{datetime.now().timestamp()}_{file.filename}")
-            save_optimized_image(file, filename)
+            filename, job = stage_upload(file, custom_id)
 
         # 4. SAVE
         new_roll = Roll(
@@ -319,20 +3163,281 @@ def add_roll():
             notes=notes, 
             contact_sheet=filename
         )
+        link_roll_gear(new_roll)
         
         try:
             db.session.add(new_roll)
             db.session.commit()
+            if job:
+                submit_image_job(job.id, filename)
             return redirect(url_for('index'))
         except Exception as e:
             db.session.rollback()
-            return render_template('add_roll.html', error="Database Error: " + str(e), next_id=custom_id,
-                                   films=existing_films, cameras=existing_cameras, lenses=existing_lenses)
+            if job:
+                os.remove(os.path.join(INCOMING_DIR, filename))
+            return render_template('add_roll.html', error="Database Error: " + str(e), next_id=custom_id)
         
-    return render_template('add_roll.html', next_id=next_id, 
-                           films=existing_films, 
-                           cameras=existing_cameras, 
-                           lenses=existing_lenses)
+    return render_template('add_roll.html', next_id=next_id)
+
+# Autocomplete, e.g. /api/suggest?field=camera&prefix=Ca
+@app.route('/api/suggest')
+def api_suggest():
+    field = request.args.get('field', '')
+    if field not in VOCAB_FIELDS:
+        return jsonify(error=f"field must be one of {', '.join(VOCAB_FIELDS)}"), 400
+    prefix = request.args.get('prefix', '')
+    try:
+        limit = min(max(int(request.args.get('limit', 10)), 1), 50)
+    except ValueError:
+        limit = 10
+
+    terms = suggest_terms(field, prefix, limit)
+    return jsonify(field=field, prefix=prefix,
+                   suggestions=[{'term': t.term, 'uses': t.uses} for t in terms])
+
+# --- JSON API v1 (rolls + gear) ---
+# Plain JSON for scanner stations and scripts: no templates, no context
+# processor. Every GET carries an ETag/Last-Modified; send If-None-Match
+# to get a 304 without the rows being read. Writes accept If-Match.
+@app.route('/api/v1/rolls', methods=['GET'])
+def api_list_rolls():
+    sort = request.args.get('sort', 'id')
+    if sort not in ROLL_SORTS:
+        return api_error(400, f"sort must be one of {', '.join(ROLL_SORTS)}")
+    descending = request.args.get('dir') != 'asc'
+    per_page = api_per_page()
+
+    version, modified = change_version(Roll)
+    etag = api_etag('rolls', version, sort, descending, per_page,
+                    request.args.get('after'), request.args.get('before'))
+    cached = api_cached(etag, modified)
+    if cached:
+        return cached
+
+    page = paginate_rolls(Roll.query, ROLL_SORTS[sort], descending=descending,
+                          after=request.args.get('after'), before=request.args.get('before'),
+                          per_page=per_page)
+    return api_response({'rolls': [roll_to_dict(r) for r in page['rolls']],
+                         'next_cursor': page['next_cursor'], 'prev_cursor': page['prev_cursor']},
+                        etag, modified)
+
+@app.route('/api/v1/rolls/batch', methods=['GET', 'POST'])
+def api_batch_rolls():
+    ids = api_batch_ids()
+    version, modified = change_version(Roll)
+    etag = api_etag('rolls-batch', version, ids)
+    cached = api_cached(etag, modified)
+    if cached:
+        return cached
+
+    # One IN query for the whole list
+    found = {roll.id: roll for roll in Roll.query.filter(Roll.id.in_(ids))}
+    return api_response({'rolls': [roll_to_dict(found[i]) for i in ids if i in found],
+                         'missing': [i for i in ids if i not in found]}, etag, modified)
+
+@app.route('/api/v1/scan', methods=['POST'])
+def api_scan():
+    # {"codes": ["0001", "ROLL #0002", ...]} - duplicates are counted, not dropped
+    codes = api_json_body().get('codes')
+    if not isinstance(codes, list) or not codes:
+        return api_error(400, 'codes must be a non-empty list of scanned codes')
+    if len(codes) > app.config['SCAN_SESSION_LIMIT']:
+        return api_error(400, f"At most {app.config['SCAN_SESSION_LIMIT']} codes per request")
+
+    entries, invalid = resolve_scans(codes)
+    response = jsonify(rolls=entries, invalid=invalid, summary=scan_summary(entries, invalid))
+    response.cache_control.no_store = True
+    return response
+
+@app.route('/api/v1/rolls/<int:roll_id>', methods=['GET'])
+def api_get_roll(roll_id):
+    # Only the timestamp is read to answer a revalidation
+    modified = db.session.execute(select(func.coalesce(Roll.date_modified, Roll.date_added))
+                                  .where(Roll.id == roll_id)).first()
+    if modified is None:
+        return api_error(404, f'Roll #{roll_id:04d} not found')
+    etag = roll_etag(roll_id, modified[0])
+    cached = api_cached(etag, modified[0])
+    if cached:
+        return cached
+    return api_response(roll_to_dict(db.session.get(Roll, roll_id)), etag, modified[0])
+
+@app.route('/api/v1/rolls', methods=['POST'])
+def api_create_roll():
+    values, errors = validate_roll_record(api_json_body())
+    if errors:
+        return api_error(400, 'Invalid roll', errors=errors)
+    if values['id'] is None:
+        values['id'] = (db.session.query(func.max(Roll.id)).scalar() or 0) + 1
+    elif roll_id_taken(values['id']):
+        return api_error(409, f"Roll #{values['id']:04d} already exists in the database")
+
+    roll = Roll(**values)
+    link_roll_gear(roll)
+    db.session.add(roll)
+    db.session.commit()
+    response = api_response(roll_to_dict(roll), roll_etag(roll.id, item_modified(roll)),
+                            item_modified(roll), status=201)
+    response.headers['Location'] = url_for('api_get_roll', roll_id=roll.id)
+    return response
+
+@app.route('/api/v1/rolls/<int:roll_id>', methods=['PUT', 'PATCH'])
+def api_update_roll(roll_id):
+    roll = db.session.get(Roll, roll_id)
+    if roll is None:
+        return api_error(404, f'Roll #{roll_id:04d} not found')
+    if request.if_match and not request.if_match.contains_weak(roll_etag(roll.id, item_modified(roll))):
+        return api_error(412, 'Roll was changed by someone else')
+
+    payload = api_json_body()
+    if payload.get('id') not in (None, roll.id):
+        return api_error(400, 'The Roll ID cannot be changed')
+    # PATCH: unspecified fields keep their value. PUT: they are cleared.
+    record = {name: getattr(roll, name) for name in ROLL_API_FIELDS} if request.method == 'PATCH' else {}
+    record.update({name: payload[name] for name in ROLL_API_FIELDS if name in payload})
+    for name in ('date_started', 'date_finished'):
+        if record.get(name) is not None and not isinstance(record[name], str):
+            record[name] = record[name].isoformat()
+    values, errors = validate_roll_record(record)
+    if errors:
+        return api_error(400, 'Invalid roll', errors=errors)
+
+    for name in ROLL_API_FIELDS:
+        setattr(roll, name, values[name])
+    link_roll_gear(roll)
+    db.session.commit()
+    return api_response(roll_to_dict(roll), roll_etag(roll.id, item_modified(roll)), item_modified(roll))
+
+@app.route('/api/v1/rolls/<int:roll_id>', methods=['DELETE'])
+def api_delete_roll(roll_id):
+    roll = db.session.get(Roll, roll_id)
+    if roll is None:
+        return api_error(404, f'Roll #{roll_id:04d} not found')
+    if request.if_match and not request.if_match.contains_weak(roll_etag(roll.id, item_modified(roll))):
+        return api_error(412, 'Roll was changed by someone else')
+
+    contact_sheet = roll.contact_sheet
+    db.session.delete(roll)
+    db.session.commit()
+    release_contact_sheet(contact_sheet)
+    return Response(status=204)
+
+def api_gear_enabled():
+    # Same switch as the Gear pages
+    if not settings.get('enable_gearlog'):
+        abort(api_error(404, 'The gear log is disabled'))
+
+@app.route('/api/v1/gear', methods=['GET'])
+def api_list_gear():
+    api_gear_enabled()
+    hw_type = request.args.get('hardware_type')
+    version, modified = change_version(Gear)
+    etag = api_etag('gear', version, hw_type)
+    cached = api_cached(etag, modified)
+    if cached:
+        return cached
+
+    query = Gear.query.order_by(Gear.hardware_type.asc(), Gear.name.asc())
+    if hw_type:
+        query = query.filter(Gear.hardware_type == hw_type)
+    return api_response({'gear': [gear_to_dict(g) for g in query]}, etag, modified)
+
+@app.route('/api/v1/gear/usage', methods=['GET'])
+def api_gear_usage():
+    api_gear_enabled()
+    hw_type = request.args.get('hardware_type')
+    # Changes to either table change the report
+    roll_version, roll_modified = change_version(Roll)
+    gear_version, gear_modified = change_version(Gear)
+    modified = max(filter(None, (roll_modified, gear_modified)), default=None)
+    etag = api_etag('gear-usage', roll_version, gear_version, hw_type)
+    cached = api_cached(etag, modified)
+    if cached:
+        return cached
+
+    usage = [{'id': row.id, 'name': row.name, 'hardware_type': row.hardware_type,
+              'serial_number': row.serial_number, 'rolls': row.rolls, 'last_used': row.last_used}
+             for row in gear_usage(hw_type)]
+    return api_response({'gear': usage}, etag, modified)
+
+@app.route('/api/v1/gear/batch', methods=['GET', 'POST'])
+def api_batch_gear():
+    api_gear_enabled()
+    ids = api_batch_ids()
+    version, modified = change_version(Gear)
+    etag = api_etag('gear-batch', version, ids)
+    cached = api_cached(etag, modified)
+    if cached:
+        return cached
+
+    found = {item.id: item for item in Gear.query.filter(Gear.id.in_(ids))}
+    return api_response({'gear': [gear_to_dict(found[i]) for i in ids if i in found],
+                         'missing': [i for i in ids if i not in found]}, etag, modified)
+
+@app.route('/api/v1/gear/<int:gear_id>', methods=['GET'])
+def api_get_gear(gear_id):
+    api_gear_enabled()
+    modified = db.session.execute(select(func.coalesce(Gear.date_modified, Gear.date_added))
+                                  .where(Gear.id == gear_id)).first()
+    if modified is None:
+        return api_error(404, f'Gear item {gear_id} not found')
+    etag = gear_etag(gear_id, modified[0])
+    cached = api_cached(etag, modified[0])
+    if cached:
+        return cached
+    return api_response(gear_to_dict(db.session.get(Gear, gear_id)), etag, modified[0])
+
+@app.route('/api/v1/gear', methods=['POST'])
+def api_create_gear():
+    api_gear_enabled()
+    values, errors = validate_gear_record(api_json_body())
+    if errors:
+        return api_error(400, 'Invalid gear item', errors=errors)
+
+    item = Gear(**values)
+    db.session.add(item)
+    db.session.commit()
+    relink_rolls()
+    response = api_response(gear_to_dict(item), gear_etag(item.id, item_modified(item)),
+                            item_modified(item), status=201)
+    response.headers['Location'] = url_for('api_get_gear', gear_id=item.id)
+    return response
+
+@app.route('/api/v1/gear/<int:gear_id>', methods=['PUT', 'PATCH'])
+def api_update_gear(gear_id):
+    api_gear_enabled()
+    item = db.session.get(Gear, gear_id)
+    if item is None:
+        return api_error(404, f'Gear item {gear_id} not found')
+    if request.if_match and not request.if_match.contains_weak(gear_etag(item.id, item_modified(item))):
+        return api_error(412, 'Gear item was changed by someone else')
+
+    payload = api_json_body()
+    record = {name: getattr(item, name) for name in GEAR_API_FIELDS} if request.method == 'PATCH' else {}
+    record.update({name: payload[name] for name in GEAR_API_FIELDS if name in payload})
+    values, errors = validate_gear_record(record)
+    if errors:
+        return api_error(400, 'Invalid gear item', errors=errors)
+
+    for name, value in values.items():
+        setattr(item, name, value)
+    db.session.commit()
+    relink_rolls()
+    return api_response(gear_to_dict(item), gear_etag(item.id, item_modified(item)), item_modified(item))
+
+@app.route('/api/v1/gear/<int:gear_id>', methods=['DELETE'])
+def api_delete_gear(gear_id):
+    api_gear_enabled()
+    item = db.session.get(Gear, gear_id)
+    if item is None:
+        return api_error(404, f'Gear item {gear_id} not found')
+    if request.if_match and not request.if_match.contains_weak(gear_etag(item.id, item_modified(item))):
+        return api_error(412, 'Gear item was changed by someone else')
+
+    db.session.delete(item)
+    db.session.commit()
+    unlink_gear(gear_id)
+    return Response(status=204)
 
 @app.route('/roll/<int:roll_id>')
 def roll_detail(roll_id):
@@ -348,158 +3453,245 @@ def edit_roll(roll_id):
         roll.camera = request.form['camera']
         roll.lens = request.form.get('lens') 
         roll.notes = request.form['notes']
-        iso_input = request.form.get('iso')
-        roll.iso = int(iso_input) if iso_input else None
+        roll.iso = parse_iso(request.form.get('iso'))
         
-        def parse_date(date_str):
-            if date_str:
-                return datetime.strptime(date_str, '%Y-%m-%d').date()
-            return None
-
         roll.date_started = parse_date(request.form.get('date_started'))
         roll.date_finished = parse_date(request.form.get('date_finished'))
         
         # Check if a NEW file was uploaded to replace the old one
         file = request.files['contact_sheet']
+        job = None
+        old_sheet = roll.contact_sheet
         if file and allowed_file(file.filename):
-            filename = secure_filename(f"{datetime.now().timestamp()}_{file.filename}")
-            save_optimized_image(file, filename)
-            
-            # (Optional) Delete old image here if you wanted to keep it clean
-            roll.contact_sheet = filename
+            roll.contact_sheet, job = stage_upload(file, roll.id)
             
+        link_roll_gear(roll)
         db.session.commit()
+        if job:
+            submit_image_job(job.id, job.filename)
+        # The replaced image goes too, unless another roll shares it
+        if old_sheet and old_sheet != roll.contact_sheet:
+            release_contact_sheet(old_sheet)
         return redirect(url_for('roll_detail', roll_id=roll.id))
     
-    # Load Autocomplete for Edit Page too
-    existing_films = [r.film_type for r in db.session.query(Roll.film_type).distinct()]
-    existing_cameras = [r.camera for r in db.session.query(Roll.camera).distinct()]
-    existing_lenses = [r.lens for r in db.session.query(Roll.lens).distinct() if r.lens]
-
-    return render_template('edit_roll.html', roll=roll,
-                           films=existing_films, 
-                           cameras=existing_cameras, 
-                           lenses=existing_lenses)
+    return render_template('edit_roll.html', roll=roll)
 
 @app.route('/delete/<int:roll_id>', methods=['POST'])
 def delete_roll(roll_id):
     roll = Roll.query.get_or_404(roll_id)
     
-    # Try to delete the image file from the folder to save space
-    if roll.contact_sheet:
-        try:
-            os.remove(os.path.join(app.config['UPLOAD_FOLDER'], roll.contact_sheet))
-        except:
-            pass 
-            
+    # Delete the image too, unless another roll shares it
+    contact_sheet = roll.contact_sheet
     db.session.delete(roll)
     db.session.commit()
+    release_contact_sheet(contact_sheet)
     return redirect(url_for('index'))
 
 @app.route('/stats')
 def stats():
-    total_rolls = Roll.query.count()
+    # Everything comes from the precomputed stat_count rows (no roll scans)
+    total = StatCount.query.filter_by(dimension='total').first()
+    total_rolls = total.rolls if total else 0
+    
+    # Top 5 Cameras / Films / Lenses
+    cameras = stat_rows('camera', limit=5)
+    films = stat_rows('film_type', limit=5)
+    lenses = stat_rows('lens', limit=5)
     
-    # Get top 5 Cameras
-    cameras = db.session.query(Roll.camera, func.count(Roll.camera)).group_by(Roll.camera).order_by(func.count(Roll.camera).desc()).limit(5).all()
+    # ISO by popularity, Months newest first (last 12)
+    isos = stat_rows('iso', limit=8)
+    months = list(reversed(stat_rows('month', limit=12, order='bucket')))
     
-    # Get top 5 Films
-    films = db.session.query(Roll.film_type, func.count(Roll.film_type)).group_by(Roll.film_type).order_by(func.count(Roll.film_type).desc()).limit(5).all()
+    # Time to finish a roll
+    finish_rows = StatCount.query.filter_by(dimension='finish').all()
+    finish_counts = {r.bucket: r.rolls for r in finish_rows}
+    finish = [(bucket, finish_counts.get(bucket, 0)) for bucket in FINISH_BUCKETS]
+    finished_rolls = sum(r.rolls for r in finish_rows)
+    avg_finish_days = sum(r.days for r in finish_rows) / finished_rolls if finished_rolls else None
     
-    return render_template('stats.html', total_rolls=total_rolls, cameras=cameras, films=films)
+    return render_template('stats.html', total_rolls=total_rolls, cameras=cameras, films=films,
+                           lenses=lenses, isos=isos, months=months, finish=finish,
+                           finished_rolls=finished_rolls, avg_finish_days=avg_finish_days)
 
 @app.route('/preferences')
 def preferences():
-    return render_template('preferences.html')
+    # Summary of the restore that just finished (shown once after redirect)
+    last_import = get_import_progress() if request.args.get('restored') else None
+    return render_template('preferences.html', last_import=last_import,
+                           label_sheets=LABEL_SHEETS, default_sheet=DEFAULT_LABEL_SHEET)
 
 @app.route('/backup')
 def backup():
     include_images = request.args.get('images') == 'true'
-    
-    # Create a memory buffer for the zip file
-    buffer = BytesIO()
-    
-    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-        # 1. Add Film Database
-        db_path = os.path.join(DATA_DIR, 'filmlog.db')
-        if os.path.exists(db_path):
-            zip_file.write(db_path, arcname='filmlog.db')
-            
-        # 2. Add Gear Database (if it exists)
-        gear_path = os.path.join(DATA_DIR, 'gearlog.db')
-        if os.path.exists(gear_path):
-            zip_file.write(gear_path, arcname='gearlog.db')
-            
-        # 3. Add Images (Optional)
-        if include_images and os.path.exists(IMAGES_DIR):
-            # Walk through the images directory and add every file
-            for root, dirs, files in os.walk(IMAGES_DIR):
-                for file in files:
-                    file_path = os.path.join(root, file)
-                    # Add to zip, preserving the "Images/" folder structure
-                    zip_file.write(file_path, arcname=os.path.join('Images', file))
-
-    buffer.seek(0)
-    
+    mode = request.args.get('mode', 'full')
+    since = request.args.get('since')
+    if mode not in BACKUP_KINDS:
+        abort(400)
+
+    # Incremental/differential: only images changed since an earlier backup
+    base = None
+    if include_images and (mode != 'full' or since):
+        base = backup_base(mode, since)
+        if since and base is None:
+            return f"Unknown base backup: {since}", 404
+    kind = (mode if mode != 'full' else 'incremental') if base else 'full'
+
     # Name the file appropriately
     date_str = datetime.now().strftime('%Y-%m-%d')
-    filename = f"FilmLog_Full_Backup_{date_str}.zip" if include_images else f"FilmLog_Data_Backup_{date_str}.zip"
+    label = kind.capitalize() if include_images else 'Data'
+    filename = f"FilmLog_{label}_Backup_{date_str}.zip"
     
-    return send_file(buffer, as_attachment=True, download_name=filename, mimetype='application/zip')
+    # Stream the zip while it is being built (constant memory, instant first byte)
+    return Response(stream_backup_zip(include_images, base, kind), mimetype='application/zip',
+                    headers={'Content-Disposition': f'attachment; filename="{filename}"'})
 # NEW ROUTE: Serve images from the custom Data/Images folder
 
 @app.route('/import_backup', methods=['POST'])
 def import_backup():
-    file = request.files['backup_file']
-    if not file or not file.filename.endswith('.zip'):
+    # A full backup, optionally with the incrementals made after it
+    files = [f for f in request.files.getlist('backup_file') if f and f.filename.endswith('.zip')]
+    if not files:
         return redirect(url_for('preferences'))
 
     try:
-        # 1. DISCONNECT FROM DATABASE (To release Windows file locks)
-        db.session.remove()
-        db.engine.dispose()
-        
-        # 2. Open the uploaded Zip
-        with zipfile.ZipFile(file) as z:
-            # 3. Extract logic
-            for member in z.namelist():
-                # Block malicious paths (basic security)
-                if '..' in member or member.startswith('/') or member.startswith('\\'):
-                    continue
-                
-                target_path = None
-                
-                # CASE A: Database Files (Extract to DATA_DIR)
-                if member in ['filmlog.db', 'gearlog.db']:
-                    target_path = os.path.join(DATA_DIR, member)
-                
-                # CASE B: Images (Extract to IMAGES_DIR)
-                # The zip stores them as "Images/filename.jpg"
-                elif member.startswith('Images/'):
-                    # Strip "Images/" from the path to get just the filename
-                    filename = os.path.basename(member)
-                    if filename: # Ensure it's not just the folder itself
-                        target_path = os.path.join(IMAGES_DIR, filename)
-                
-                # Perform the extraction if we found a valid target
-                if target_path:
-                    # Create directory if missing
-                    os.makedirs(os.path.dirname(target_path), exist_ok=True)
-                    # Write the file
-                    with open(target_path, "wb") as f:
-                        f.write(z.read(member))
-                        
-        # 4. Trigger Restart Warning
-        # We redirect with 'restart=True' so the user knows to relaunch the app
-        # to re-establish the database connection cleanly.
-        return redirect(url_for('preferences', restart=True))
+        # 1. Stream every member to disk, then hot-swap the databases
+        restore_backup_zip([f.stream for f in files])
+
+        # 2. The restored DB may come from an older version - upgrade it
+        init_database()
+        settings.invalidate()
+
+        # 3. No restart needed - the engines reconnect to the new files
+        return redirect(url_for('preferences', restored=1))
 
     except Exception as e:
         return f"Error importing backup: {str(e)}", 500
 
+@app.route('/storage/cleanup', methods=['POST'])
+def cleanup_images():
+    dry_run = request.form.get('dry_run') in ('on', 'true', '1')
+    renamed = merged = freed = 0
+    if not dry_run:
+        # Old timestamp-named files first, so their duplicates count as reclaimed
+        renamed, merged, freed = dedupe_legacy_images()
+    report = collect_image_garbage(dry_run=dry_run)
+    report.update(renamed=renamed, merged=merged, bytes=report['bytes'] + freed)
+    return render_template('preferences.html', image_cleanup=report,
+                           label_sheets=LABEL_SHEETS, default_sheet=DEFAULT_LABEL_SHEET)
+
+@app.route('/import_backup/status')
+def import_backup_status():
+    # Poll this while a large restore is running
+    return jsonify(get_import_progress())
+
+@app.route('/import_rolls', methods=['POST'])
+def import_rolls_upload():
+    file = request.files.get('rolls_file')
+    fmt = import_format(file.filename) if file else None
+    if not fmt:
+        return jsonify({'error': 'Upload a .csv, .json, .jsonl or .ndjson file'}), 400
+
+    dry_run = request.form.get('dry_run') in ('on', 'true', '1')
+    # Decode the upload as it is read - the file is never loaded whole
+    text_stream = io.TextIOWrapper(file.stream, encoding='utf-8-sig', newline='')
+    try:
+        report = import_rolls(text_stream, fmt, dry_run=dry_run)
+    finally:
+        text_stream.detach()
+
+    # Scripts get the raw report; the Preferences form gets a summary page
+    if request.args.get('format') == 'json' or request.accept_mimetypes.best == 'application/json':
+        return jsonify(report)
+    return render_template('preferences.html', roll_import=report,
+                           label_sheets=LABEL_SHEETS, default_sheet=DEFAULT_LABEL_SHEET)
+
+# Which roll is this print from? Upload a scan/photo, get the closest contact sheets
+@app.route('/similar', methods=['GET', 'POST'])
+def find_similar():
+    wants_json = request.args.get('format') == 'json' or request.accept_mimetypes.best == 'application/json'
+    if request.method == 'GET':
+        return render_template('similar.html')
+
+    file = request.files.get('image')
+    if not file or not allowed_file(file.filename):
+        message = 'Upload a JPG or PNG image'
+        return api_error(400, message) if wants_json else render_template('similar.html', error=message)
+    try:
+        # Hashed straight from the upload stream - nothing is saved
+        phash = file_phash(file.stream)
+    except (OSError, ValueError):
+        message = 'That file could not be read as an image'
+        return api_error(400, message) if wants_json else render_template('similar.html', error=message)
+
+    max_distance = request.values.get('max_distance', type=int)
+    limit = request.values.get('limit', type=int)
+    if limit is not None:
+        limit = min(max(limit, 1), 100)
+    started = time.perf_counter()
+    matches = find_similar_rolls(phash, max_distance=max_distance, limit=limit)
+    elapsed_ms = round((time.perf_counter() - started) * 1000, 2)
+
+    if wants_json:
+        return jsonify(hash=f'{phash:016x}', indexed=len(image_index), elapsed_ms=elapsed_ms,
+                       matches=[dict(roll_to_dict(roll), distance=distance,
+                                     similarity=round(100 * (1 - distance / 64)))
+                                for roll, distance in matches])
+    return render_template('similar.html', matches=matches, indexed=len(image_index),
+                           elapsed_ms=elapsed_ms, searched=file.filename)
+
 @app.route('/images/<filename>')
 def serve_image(filename):
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    # Still being optimised? Show the raw upload in the meantime
+    if not os.path.exists(os.path.join(app.config['UPLOAD_FOLDER'], filename)):
+        if os.path.exists(os.path.join(INCOMING_DIR, filename)):
+            return image_response(INCOMING_DIR, filename, immutable=False)
+        # Pre-dedupe URL: send the browser to the content-hashed name
+        current = resolve_image_alias(filename)
+        if current:
+            return redirect(url_for('serve_image', filename=current), 301)
+    return stored_image_response(app.config['UPLOAD_FOLDER'], filename, filename)
+
+@app.route('/metrics')
+def metrics_endpoint():
+    with server_state_lock:
+        active = server_state['active']
+    gauges = [
+        ('filmlog_active_requests', active),
+        ('filmlog_image_jobs_queued', ImageJob.query.filter_by(state='queued').count()),
+        ('filmlog_start_time_seconds', f'{metrics.started:.0f}'),
+    ]
+    return Response(metrics.render(gauges), mimetype='text/plain; version=0.0.4')
+
+# Background image job status
+@app.route('/jobs')
+def list_image_jobs():
+    state = request.args.get('state')
+    query = ImageJob.query
+    if state:
+        query = query.filter_by(state=state)
+    jobs = query.order_by(ImageJob.id.desc()).limit(100).all()
+    return jsonify([image_job_status(job) for job in jobs])
+
+@app.route('/jobs/<int:job_id>')
+def image_job(job_id):
+    return jsonify(image_job_status(ImageJob.query.get_or_404(job_id)))
+
+# Resized copy, e.g. /images/960/webp/1700000.12_scan.jpg
+@app.route('/images/<int:width>/<fmt>/<filename>')
+def serve_image_variant(filename, width, fmt):
+    if width not in app.config['THUMBNAIL_WIDTHS'] or fmt not in THUMBNAIL_FORMAT_NAMES:
+        abort(404)
+    variant = thumbnail_name(filename, width, fmt)
+    if not os.path.exists(os.path.join(THUMBS_DIR, variant)):
+        current = resolve_image_alias(filename)
+        if current:
+            return redirect(url_for('serve_image_variant', filename=current, width=width, fmt=fmt), 301)
+        # Not generated (yet) - the original is always a safe fallback
+        response = serve_image(filename)
+        response.cache_control.immutable = False
+        response.cache_control.max_age = 0
+        return response
+    return stored_image_response(THUMBS_DIR, variant, filename)
     
 @app.route('/generate_labels', methods=['POST'])
 def generate_labels():
@@ -509,80 +3701,40 @@ def generate_labels():
     except ValueError:
         start_num = 1
         count = 65
+    start_num = max(start_num, 0)
+    count = max(count, 1)
+    # Bound the work (and the cached file) one request can ask for
+    max_count = app.config['LABEL_MAX_COUNT']
+    if count > max_count:
+        return f"At most {max_count} labels per download", 400
+    end_num = start_num + count - 1
+    if end_num > LABEL_MAX_NUMBER:
+        return f"Label numbers stop at {LABEL_MAX_NUMBER}", 400
 
-    # Setup PDF Buffer (In Memory)
-    buffer = BytesIO()
-    c = canvas.Canvas(buffer, pagesize=A4)
-    width, height = A4
-    
-    # --- YOUR LAYOUT CONFIGURATION (Avery L7651) ---
-    COLUMNS = 5
-    ROWS = 13
-    LABEL_WIDTH = 38 * mm
-    LABEL_HEIGHT = 21 * mm
-    MARGIN_X = 10 * mm
-    MARGIN_Y = 12 * mm
-    GAP_X = 2 * mm
-    GAP_Y = 0 * mm
-    # -----------------------------------------------
-
-    current_num = start_num
-    
-    for i in range(count):
-        # Calculate Grid Position
-        col = i % COLUMNS
-        row = (i // COLUMNS) % ROWS
-        
-        # New page if we fill the sheet
-        if i > 0 and i % (COLUMNS * ROWS) == 0:
-            c.showPage()
-
-        # Calculate Coordinates
-        x = MARGIN_X + (col * (LABEL_WIDTH + GAP_X))
-        # ReportLab draws from bottom-up, so we invert the row logic
-        y = height - MARGIN_Y - ((row + 1) * (LABEL_HEIGHT + GAP_Y))
-
-        # 1. Draw Text (Roll ID) - Centered
-        roll_id_str = f"{current_num:04d}"
-        c.setFont("Courier-Bold", 8) # Size 8 to fit small label
-        
-        # Center text logic
-        text_width = c.stringWidth(f"ROLL #{roll_id_str}", "Courier-Bold", 8)
-        text_x = x + (LABEL_WIDTH - text_width) / 2
-        c.drawString(text_x, y + 14*mm, f"ROLL #{roll_id_str}")
-
-        # 2. Draw Barcode (Code128)
-        # Scaled to fit inside the 38mm width
-        barcode = code128.Code128(roll_id_str, barHeight=8*mm, barWidth=0.18*mm)
-        
-        # Center barcode logic
-        barcode_width = barcode.width
-        barcode_x = x + (LABEL_WIDTH - barcode_width) / 2
-        
-        # FIX: Draw directly on canvas instead of using renderPDF
-        barcode.drawOn(c, barcode_x, y + 4*mm)
-        
-        current_num += 1
+    profile_key = request.form.get('sheet', DEFAULT_LABEL_SHEET)
+    if profile_key not in LABEL_SHEETS:
+        profile_key = DEFAULT_LABEL_SHEET
 
-    c.save()
-    buffer.seek(0)
-    
-    return send_file(buffer, as_attachment=True, download_name=f'labels_{start_num}_to_{current_num-1}.pdf', mimetype='application/pdf')
+    # Reused from the on-disk cache, or streamed page by page while rendering
+    return label_pdf_response(profile_key, start_num, count, f'labels_{start_num}_to_{end_num}.pdf')
 
 # INIT DB & START SERVER
 if __name__ == '__main__':
+    # Needed for the image worker processes in the frozen EXE
+    multiprocessing.freeze_support()
+
     with app.app_context():
-        db.create_all()
+        init_database()
+        resumed = resume_image_jobs()
+        if resumed:
+            print(f" * Resumed {resumed} queued image job(s)")
         
         # Load Network Settings from DB (or use defaults)
         # We must query inside the app_context
         try:
-            p_setting = AppSetting.query.filter_by(key='server_port').first()
-            port = int(p_setting.value) if p_setting else 5000
-            
-            h_setting = AppSetting.query.filter_by(key='server_host').first()
-            host = h_setting.value if h_setting else '0.0.0.0'
-        except:
+            port = settings.get('server_port')
+            host = settings.get('server_host')
+        except Exception:
             # Fallback if DB isn't ready or query fails
             port = 5000
             host = '0.0.0.0'
@@ -592,6 +3744,11 @@ if __name__ == '__main__':
         # SAVE RUNNING CONFIG TO APP MEMORY (For comparison)
         app.config['RUNNING_PORT'] = port
         app.config['RUNNING_HOST'] = host
+
+    # Warm the template cache while the server starts listening
+    if app.config['TEMPLATE_PRECOMPILE'] and app.config['TEMPLATE_CACHE_DIR']:
+        threading.Thread(target=precompile_templates, daemon=True).start()
         
-    # Start the app with the loaded settings
-    app.run(debug=True, host=host, port=port)
\ No newline at end of file
+    # Start the app with the loaded settings (production server unless
+    # 'Development' mode was picked in Preferences)
+    run_server(host, port)
@@ -0,0 +1,456 @@
+"""FilmLog benchmark harness.
+
+Generates synthetic Data folders (filmlog.db, gearlog.db, contact sheets) and
+times the main routes through the Flask test client. Each scale runs in its
+own process because app.py picks its Data folder at import time.
+
+    python benchmark.py --scales 1000 100000 --images 2000 --out bench.json
+    python benchmark.py --scales 1000 --compare bench.json
+
+Data folders are kept in --data-root and reused by later runs with the same
+scale/images/seed (pass --regenerate to rebuild them).
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import date, datetime, timedelta
+
+HERE = os.path.abspath(os.path.dirname(__file__))
+
+# --- SYNTHETIC DATA ---
+FILMS = [
+    ('Kodak Portra 400', 400), ('Kodak Portra 160', 160), ('Kodak Gold 200', 200),
+    ('Kodak Ektar 100', 100), ('Kodak Tri-X 400', 400), ('Ilford HP5 Plus', 400),
+    ('Ilford Delta 3200', 3200), ('Ilford FP4 Plus', 125), ('Fujifilm Superia 400', 400),
+    ('Fujifilm Velvia 50', 50), ('CineStill 800T', 800), ('Fomapan 100', 100),
+    ('Lomography Color 400', 400), ('Kodak ColorPlus 200', 200), ('Ilford XP2 Super', 400),
+]
+CAMERA_MAKES = ['Nikon', 'Canon', 'Pentax', 'Olympus', 'Minolta', 'Leica', 'Mamiya', 'Yashica', 'Contax', 'Hasselblad']
+CAMERA_MODELS = ['FM2', 'F3', 'AE-1', 'A-1', 'K1000', 'MX', 'OM-1', 'OM-2', 'XD-7', 'X-700', 'M6', 'RB67',
+                 'T2', 'Electro 35', '500C/M', 'G2', 'F100', 'EOS 3', 'Spotmatic', 'Trip 35']
+LENSES = ['24mm f/2.8', '28mm f/2', '35mm f/1.4', '35mm f/2', '40mm f/2.8', '50mm f/1.4', '50mm f/1.8',
+          '55mm f/1.2', '85mm f/1.8', '90mm f/2.8', '105mm f/2.5', '135mm f/2.8', '80mm f/2.8', '28-70mm f/3.5']
+NOTE_WORDS = ('beach city night portrait family holiday street market forest mountain lake snow rain '
+              'sunset sunrise wedding birthday garden harbour bridge train station cafe concert festival '
+              'dog cat friends road trip desert river coast village museum park autumn spring summer winter '
+              'pushed pulled expired overexposed underexposed light leak test roll home developed lab scan').split()
+
+def camera_name(rng):
+    return f"{rng.choice(CAMERA_MAKES)} {rng.choice(CAMERA_MODELS)}"
+
+def synthetic_rolls(count, rng, images):
+    """Yields roll rows as tuples in INSERT column order"""
+    first_day = date(1995, 1, 1).toordinal()
+    last_day = date(2025, 12, 31).toordinal()
+    for roll_id in range(1, count + 1):
+        film, iso = rng.choice(FILMS)
+        started = date.fromordinal(rng.randint(first_day, last_day))
+        finished = started + timedelta(days=rng.randint(0, 120)) if rng.random() < 0.9 else None
+        added = datetime.combine(started, datetime.min.time()) + timedelta(seconds=rng.randint(0, 86399))
+        notes = ' '.join(rng.choices(NOTE_WORDS, k=rng.randint(3, 20)))
+        contact_sheet = images[roll_id - 1] if roll_id <= len(images) else None
+        yield (roll_id, film, iso, camera_name(rng), rng.choice(LENSES) if rng.random() < 0.8 else None,
+               started.isoformat(), finished.isoformat() if finished else None,
+               added.strftime('%Y-%m-%d %H:%M:%S.%f'), added.strftime('%Y-%m-%d %H:%M:%S.%f'),
+               contact_sheet, notes)
+
+def make_sample_image(width=3000, height=2000, seed=0):
+    """A noisy JPEG roughly the size of a scanned contact sheet"""
+    from PIL import Image
+    rng = random.Random(seed)
+    img = Image.effect_noise((width // 4, height // 4), 64).convert('RGB')
+    img = img.resize((width, height))
+    tint = Image.new('RGB', (width, height), (rng.randint(0, 255), rng.randint(0, 255), rng.randint(0, 255)))
+    img = Image.blend(img, tint, 0.4)
+    buf = io.BytesIO()
+    img.save(buf, 'JPEG', quality=90)
+    buf.seek(0)
+    return buf
+
+def generate_data_dir(data_dir, scale, images, seed):
+    """Builds a Data folder through the app's own schema, then bulk-loads it"""
+    import app as filmlog
+
+    rng = random.Random(seed)
+    started = time.time()
+
+    # 1. Empty schema (tables, indexes, triggers) at the current version
+    with filmlog.app.app_context():
+        filmlog.init_database()
+        filmlog.db.session.remove()
+        for engine in filmlog.db.engines.values():
+            engine.dispose()
+
+    # 2. Contact sheets: process one real upload, copy it (and its thumbnails)
+    image_names = []
+    if images:
+        with filmlog.app.app_context():
+            template = 'bench_template.jpg'
+            filmlog.save_optimized_image(make_sample_image(seed=seed), template)
+        variants = [(w, f) for w in filmlog.app.config['THUMBNAIL_WIDTHS'] for f in filmlog.thumbnail_formats()]
+        for i in range(images):
+            name = f"{1700000000 + i}.000000_bench_{i:06d}.jpg"
+            shutil.copyfile(os.path.join(filmlog.IMAGES_DIR, template), os.path.join(filmlog.IMAGES_DIR, name))
+            for width, fmt in variants:
+                src = os.path.join(filmlog.THUMBS_DIR, filmlog.thumbnail_name(template, width, fmt))
+                if os.path.exists(src):
+                    shutil.copyfile(src, os.path.join(filmlog.THUMBS_DIR, filmlog.thumbnail_name(name, width, fmt)))
+            image_names.append(name)
+        os.remove(os.path.join(filmlog.IMAGES_DIR, template))
+        filmlog.remove_thumbnails(template)
+
+    # 3. Rolls (the app's triggers fill search, vocabulary and stats as they go)
+    conn = sqlite3.connect(os.path.join(data_dir, 'filmlog.db'))
+    conn.execute('PRAGMA synchronous = OFF')
+    rows = synthetic_rolls(scale, rng, image_names)
+    while True:
+        chunk = [row for _, row in zip(range(10000), rows)]
+        if not chunk:
+            break
+        with conn:
+            conn.executemany(
+                "INSERT INTO roll (id, film_type, iso, camera, lens, date_started, date_finished, "
+                "date_added, date_modified, contact_sheet, notes) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", chunk)
+    conn.close()
+
+    # 3b. Perceptual hashes (one random hash per roll) for the find-similar index
+    conn = sqlite3.connect(os.path.join(data_dir, 'filmlog.db'))
+    with conn:
+        conn.executemany("INSERT INTO image_hash (filename, phash) VALUES (?, ?)",
+                         ((f'bench_hash_{i:07d}.jpg', f'{rng.getrandbits(64):016x}') for i in range(scale)))
+    conn.close()
+
+    # 4. Gear
+    conn = sqlite3.connect(os.path.join(data_dir, 'gearlog.db'))
+    with conn:
+        conn.executemany(
+            "INSERT INTO gear (name, hardware_type, serial_number, date_added, date_modified) VALUES (?, ?, ?, ?, ?)",
+            [(camera_name(rng) if i % 2 else rng.choice(LENSES), 'Camera' if i % 2 else 'Lens',
+              str(rng.randint(100000, 999999)), '2020-01-01 00:00:00.000000', '2020-01-01 00:00:00.000000')
+             for i in range(max(20, min(scale // 100, 2000)))])
+    conn.close()
+
+    return {'scale': scale, 'images': images, 'seed': seed, 'image_names': image_names,
+            'generate_s': round(time.time() - started, 2)}
+
+# --- TIMING ---
+def summarize(timings, byte_counts=None, errors=0):
+    timings_ms = sorted(t * 1000 for t in timings)
+    total = sum(timings)
+
+    def pct(p):
+        return round(timings_ms[min(len(timings_ms) - 1, int(round(p / 100 * (len(timings_ms) - 1))))], 3)
+
+    result = {
+        'count': len(timings),
+        'errors': errors,
+        'total_s': round(total, 4),
+        'mean_ms': round(statistics.mean(timings_ms), 3),
+        'p50_ms': pct(50),
+        'p95_ms': pct(95),
+        'p99_ms': pct(99),
+        'min_ms': round(timings_ms[0], 3),
+        'max_ms': round(timings_ms[-1], 3),
+        'req_per_s': round(len(timings) / total, 2) if total else None,
+    }
+    if byte_counts:
+        result['bytes_mean'] = int(statistics.mean(byte_counts))
+        result['mb_per_s'] = round(sum(byte_counts) / 1e6 / total, 2) if total else None
+    return result
+
+def measure(fn, iterations, warmup=1):
+    """Runs fn(i) -> (ok, bytes); warm-up calls are not recorded"""
+    for i in range(warmup):
+        fn(-1 - i)
+    timings, byte_counts, errors = [], [], 0
+    for i in range(iterations):
+        started = time.perf_counter()
+        ok, size = fn(i)
+        timings.append(time.perf_counter() - started)
+        byte_counts.append(size)
+        errors += 0 if ok else 1
+    return summarize(timings, byte_counts if any(byte_counts) else None, errors)
+
+def drain(response):
+    """Reads a (possibly streamed) response to the end. Returns its size."""
+    size = 0
+    for chunk in response.response:
+        size += len(chunk)
+    response.close()
+    return size
+
+# --- BENCHMARKS ---
+def run_benchmarks(meta, iterations, heavy_iterations):
+    import app as filmlog
+
+    filmlog.app.config['IMAGE_WORKERS'] = 0  # time image processing inside the request
+    client = filmlog.app.test_client()
+    rng = random.Random(meta['seed'] + 1)
+    results = {}
+
+    with filmlog.app.app_context():
+        filmlog.init_database()
+        max_id = filmlog.db.session.query(filmlog.func.max(filmlog.Roll.id)).scalar() or 0
+
+    def timed(name, fn, count, warmup=1):
+        print(f" * {name} ({count}x)")
+        results[name] = measure(fn, count, warmup)
+
+    # 1. Index search (text terms, multi-word, roll ID lookup)
+    terms = ['Portra', 'HP5', 'Nikon FM2', 'summer', 'beach night', 'Tri-X 400', 'expired', 'Leica']
+
+    def search(i):
+        response = client.get('/', query_string={'q': terms[i % len(terms)]})
+        return response.status_code == 200, len(response.data)
+
+    def search_id(i):
+        response = client.get('/', query_string={'q': str(rng.randint(1, max(max_id, 1)))})
+        return response.status_code in (200, 302), len(response.data)
+
+    timed('index_search', search, iterations)
+    timed('index_search_id', search_id, iterations)
+
+    def scan_box(i):
+        # Auditing a box of 200 canisters (a few missing, a few scanned twice)
+        codes = [f'{rng.randint(1, max(max_id, 1) + 20):04d}' for _ in range(200)]
+        response = client.post('/api/v1/scan', json={'codes': codes + codes[:5]})
+        return response.status_code == 200, len(response.data)
+
+    timed('scan_session_200', scan_box, iterations)
+    timed('index_home', lambda i: (lambda r: (r.status_code == 200, len(r.data)))(client.get('/')), iterations)
+    timed('roll_list', lambda i: (lambda r: (r.status_code == 200, len(r.data)))(
+        client.get('/rolls', query_string={'sort': 'date'})), iterations)
+
+    # 2. Add roll (with and without a contact sheet), removed again afterwards
+    sample = make_sample_image(seed=meta['seed']).getvalue()
+
+    def add_roll(i, with_image=False):
+        film, iso = rng.choice(FILMS)
+        form = {'roll_id': '', 'film_type': film, 'iso': str(iso), 'camera': camera_name(rng),
+                'lens': rng.choice(LENSES), 'date_started': '2024-06-01', 'date_finished': '',
+                'notes': ' '.join(rng.choices(NOTE_WORDS, k=8)),
+                'contact_sheet': (io.BytesIO(sample if with_image else b''), 'bench.jpg' if with_image else '')}
+        response = client.post('/add', data=form, content_type='multipart/form-data')
+        return response.status_code == 302, 0
+
+    timed('add_roll', add_roll, iterations)
+    timed('add_roll_image', lambda i: add_roll(i, with_image=True), heavy_iterations)
+    with filmlog.app.app_context():
+        sheets = {roll.contact_sheet for roll in filmlog.Roll.query.filter(filmlog.Roll.id > max_id)}
+        filmlog.Roll.query.filter(filmlog.Roll.id > max_id).delete()
+        filmlog.ImageJob.query.delete()
+        filmlog.db.session.commit()
+        for sheet in sheets:
+            filmlog.release_contact_sheet(sheet)
+
+    # 3. Stats + JSON API
+    timed('stats', lambda i: (lambda r: (r.status_code == 200, len(r.data)))(client.get('/stats')), iterations)
+    timed('api_rolls', lambda i: (lambda r: (r.status_code == 200, len(r.data)))(
+        client.get('/api/v1/rolls', query_string={'per_page': 100})), iterations)
+
+    # 4. Serve image (full size, thumbnail, revalidation)
+    images = meta['image_names']
+    if images:
+        fmt = filmlog.thumbnail_formats()[0]
+        width = filmlog.app.config['THUMBNAIL_WIDTHS'][0]
+
+        def serve(i, variant=False):
+            name = rng.choice(images)
+            url = f'/images/{width}/{fmt}/{name}' if variant else f'/images/{name}'
+            response = client.get(url)
+            return response.status_code == 200, drain(response)
+
+        etag = client.get(f'/images/{images[0]}').headers.get('ETag')
+
+        def revalidate(i):
+            response = client.get(f'/images/{images[0]}', headers={'If-None-Match': etag})
+            return response.status_code == 304, 0
+
+        timed('serve_image', serve, iterations)
+        timed('serve_image_thumbnail', lambda i: serve(i, variant=True), iterations)
+        timed('serve_image_304', revalidate, iterations)
+
+    # 4b. Find a roll by image (decode + hash the upload, search the index)
+    probe = make_sample_image(seed=meta['seed'] + 1).getvalue()
+
+    def similar(i):
+        response = client.post('/similar', query_string={'format': 'json'},
+                               data={'image': (io.BytesIO(probe), 'print.jpg')},
+                               content_type='multipart/form-data')
+        return response.status_code == 200, len(response.data)
+
+    timed('find_similar', similar, iterations)
+
+    # 5. Label PDFs (cold = fresh range each time, warm = served from the cache)
+    def labels(i, start=None):
+        form = {'sheet': filmlog.DEFAULT_LABEL_SHEET, 'label_count': '650',
+                'start_num': str(start if start is not None else rng.randint(1, 10 ** 6))}
+        response = client.post('/generate_labels', data=form)
+        return response.status_code == 200, drain(response)
+
+    timed('generate_labels', labels, heavy_iterations)
+    timed('generate_labels_cached', lambda i: labels(i, start=1), iterations)
+
+    # 6. Backup (streamed zip) and restoring that same backup
+    backup_path = os.path.join(tempfile.gettempdir(), f'filmlog_bench_{os.getpid()}.zip')
+
+    def backup(i, images_too=False, mode='full'):
+        query = {'images': 'true', 'mode': mode} if images_too else {}
+        response = client.get('/backup', query_string=query, buffered=False)
+        size = 0
+        with open(backup_path, 'wb') as f:
+            for chunk in response.response:
+                f.write(chunk)
+                size += len(chunk)
+        response.close()
+        return response.status_code == 200, size
+
+    def import_backup(i):
+        with open(backup_path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            response = client.post('/import_backup', data={'backup_file': (f, 'bench.zip')},
+                                   content_type='multipart/form-data')
+        return response.status_code == 302, size
+
+    try:
+        if images:
+            timed('backup_full', lambda i: backup(i, images_too=True), heavy_iterations)
+            timed('backup_incremental', lambda i: backup(i, images_too=True, mode='incremental'), heavy_iterations)
+        timed('backup', backup, heavy_iterations)
+        timed('import_backup', import_backup, heavy_iterations, warmup=0)
+    finally:
+        if os.path.exists(backup_path):
+            os.remove(backup_path)
+
+    return results
+
+# --- DRIVER ---
+def worker(args):
+    """One scale, in this process (FILMLOG_DATA_DIR is already set)"""
+    data_dir = os.environ['FILMLOG_DATA_DIR']
+    meta_path = os.path.join(data_dir, 'benchmark_meta.json')
+    meta = None
+    if os.path.exists(meta_path) and not args.regenerate:
+        with open(meta_path) as f:
+            meta = json.load(f)
+        if (meta['scale'], meta['images'], meta['seed']) != (args.scale, args.images, args.seed):
+            meta = None
+    if meta is None:
+        if os.path.exists(data_dir):
+            shutil.rmtree(data_dir)
+        os.makedirs(data_dir)
+        print(f" * Generating {args.scale} rolls / {args.images} images in {data_dir}")
+        meta = generate_data_dir(data_dir, args.scale, args.images, args.seed)
+        with open(meta_path, 'w') as f:
+            json.dump(meta, f)
+    else:
+        print(f" * Reusing {data_dir}")
+
+    results = run_benchmarks(meta, args.iterations, args.heavy_iterations)
+    run = {'scale': meta['scale'], 'images': meta['images'], 'generate_s': meta['generate_s'],
+           'db_mb': round(os.path.getsize(os.path.join(data_dir, 'filmlog.db')) / 1e6, 1),
+           'results': results}
+    with open(args.worker_out, 'w') as f:
+        json.dump(run, f)
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=HERE, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(report, baseline_path, threshold):
+    """Prints p50 changes against an earlier report. Returns the regressions."""
+    with open(baseline_path) as f:
+        baseline = {run['scale']: run['results'] for run in json.load(f)['runs']}
+    regressions = []
+    for run in report['runs']:
+        old = baseline.get(run['scale'])
+        if not old:
+            continue
+        print(f"\n * Scale {run['scale']} vs {baseline_path}")
+        for name, new in run['results'].items():
+            if name not in old or not old[name]['p50_ms']:
+                continue
+            ratio = new['p50_ms'] / old[name]['p50_ms']
+            flag = '  <-- REGRESSION' if ratio > 1 + threshold else ''
+            print(f"   {name:<24} {old[name]['p50_ms']:>10.2f} -> {new['p50_ms']:>10.2f} ms  ({ratio:.2f}x){flag}")
+            if flag:
+                regressions.append((run['scale'], name, ratio))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scales', type=int, nargs='+', default=[1000, 100000], help='Roll counts to test')
+    parser.add_argument('--images', type=int, default=1000, help='Contact sheets per data folder')
+    parser.add_argument('--iterations', type=int, default=50, help='Requests per light benchmark')
+    parser.add_argument('--heavy-iterations', type=int, default=3, help='Runs of backup/restore/labels/uploads')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--data-root', default=os.path.join(tempfile.gettempdir(), 'filmlog_bench'))
+    parser.add_argument('--regenerate', action='store_true', help='Rebuild data folders even if cached')
+    parser.add_argument('--out', default=None, help='JSON results file (default: bench_<timestamp>.json)')
+    parser.add_argument('--compare', default=None, help='Earlier results file to compare against')
+    parser.add_argument('--threshold', type=float, default=0.2, help='p50 slowdown counted as a regression')
+    parser.add_argument('--scale', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--worker-out', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker_out:
+        worker(args)
+        return
+
+    report = {
+        'meta': {
+            'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'iterations': args.iterations,
+            'heavy_iterations': args.heavy_iterations,
+        },
+        'runs': [],
+    }
+
+    for scale in args.scales:
+        data_dir = os.path.join(args.data_root, f'rolls_{scale}_images_{args.images}')
+        fd, run_out = tempfile.mkstemp(suffix='.json')
+        os.close(fd)
+        cmd = [sys.executable, os.path.abspath(__file__), '--scale', str(scale), '--images', str(args.images),
+               '--iterations', str(args.iterations), '--heavy-iterations', str(args.heavy_iterations),
+               '--seed', str(args.seed), '--worker-out', run_out] + (['--regenerate'] if args.regenerate else [])
+        try:
+            subprocess.run(cmd, check=True, env=dict(os.environ, FILMLOG_DATA_DIR=data_dir))
+            with open(run_out) as f:
+                report['runs'].append(json.load(f))
+        finally:
+            os.remove(run_out)
+
+    out = args.out or f"bench_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
+    with open(out, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f" * Results written to {out}")
+
+    for run in report['runs']:
+        print(f"\n * {run['scale']} rolls, {run['images']} images ({run['db_mb']} MB DB)")
+        for name, r in run['results'].items():
+            print(f"   {name:<24} p50 {r['p50_ms']:>10.2f} ms   p95 {r['p95_ms']:>10.2f} ms   "
+                  f"{r['req_per_s'] or 0:>8.1f} req/s" + (f"   {r['mb_per_s']} MB/s" if r.get('mb_per_s') else ''))
+
+    if args.compare and compare(report, args.compare, args.threshold):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()